@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+'''
+Build Several OpenShift Clusters Concurrently with prepOpenShift.sh
+'''
+
+import os
+import sys
+import argparse
+import subprocess
+import threading
+import time
+import concurrent.futures
+
+class clusterBuilder(object):
+
+    def __init__(self):
+        self.scriptDir = os.path.dirname(os.path.abspath(__file__))
+        self.prepScript = self.scriptDir + '/prepOpenShift.sh'
+        self.printLock = threading.Lock()
+        self.parse_args()
+
+        clusterList = self.getClusterList()
+        if not clusterList:
+            print("At least one install config template is required.")
+            sys.exit(1)
+
+        try:
+            os.makedirs(self.logDir, exist_ok=True)
+        except OSError as e:
+            print("Can not create log directory: %s" % str(e))
+            sys.exit(1)
+
+        results = self.buildClusters(clusterList)
+        self.printSummary(results)
+
+        if [result for result in results if result['status'] != 0]:
+            sys.exit(1)
+
+    def getClusterList(self):
+        import yaml
+
+        clusterList = []
+        nameList = set()
+
+        # Each entry is name=template or a template whose metadata.name is used
+        for item in self.templateList:
+            if '=' in item:
+                name, template = item.split('=', 1)
+            else:
+                template = item
+                try:
+                    with open(template, 'r') as cfgYamlFile:
+                        name = yaml.safe_load(cfgYamlFile)['metadata']['name']
+                except (OSError, KeyError, TypeError) as e:
+                    print("Can not read cluster name from %s: %s" % (template, str(e)))
+                    sys.exit(1)
+
+            if name in nameList:
+                print("Cluster %s is listed more than once." % name)
+                sys.exit(1)
+            nameList.add(name)
+
+            if not os.path.exists(template):
+                print("Can not find template file %s" % template)
+                sys.exit(1)
+
+            answerFile = None
+            if self.answerDir and os.path.exists(self.answerDir + '/' + name + '.answers'):
+                answerFile = self.answerDir + '/' + name + '.answers'
+
+            clusterList.append((name, os.path.abspath(template), answerFile))
+
+        return clusterList
+
+    def buildCluster(self, name, template, answerFile):
+        logFile = self.logDir + '/' + name + '.log'
+        command = [self.prepScript, '-e', name, '-t', template]
+        if self.baseDir:
+            command.extend(['-d', self.baseDir])
+        if self.promDir:
+            command.extend(['-m', self.promDir + '/' + name + '.prom'])
+
+        with self.printLock:
+            print("Starting %s, log %s" % (name, logFile))
+
+        start = time.time()
+        try:
+            with open(logFile, 'w') as logOutput:
+                if answerFile:
+                    with open(answerFile, 'r') as answerInput:
+                        result = subprocess.run(command, stdin=answerInput, stdout=logOutput, stderr=subprocess.STDOUT)
+                else:
+                    result = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=logOutput, stderr=subprocess.STDOUT)
+            status = result.returncode
+        except OSError as e:
+            print("Can not run %s for %s: %s" % (self.prepScript, name, str(e)))
+            status = 1
+        duration = time.time() - start
+
+        with self.printLock:
+            print("Finished %s in %d s: %s" % (name, duration, 'ok' if status == 0 else 'failed'))
+
+        return {'name': name, 'status': status, 'duration': duration, 'log': logFile}
+
+    def buildClusters(self, clusterList):
+        results = []
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.parallel) as executor:
+            futures = [executor.submit(self.buildCluster, *cluster) for cluster in clusterList]
+            for future in futures:
+                results.append(future.result())
+
+        return results
+
+    def printSummary(self, results):
+        print("")
+        print("%-20s %-8s %10s  %s" % ('cluster', 'status', 'time', 'log'))
+        for result in results:
+            print("%-20s %-8s %8d s  %s" % (result['name'], 'ok' if result['status'] == 0 else 'failed',
+                                            result['duration'], result['log']))
+        okCount = len([result for result in results if result['status'] == 0])
+        print("%d of %d clusters built." % (okCount, len(results)))
+
+    def parse_args(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument('templates', nargs='*')
+        parser.add_argument('--parallel', action='store', type=int, default=2)
+        parser.add_argument('--dir', action='store')
+        parser.add_argument('--logs', action='store', default=os.environ.get('HOME', '/var/tmp') + '/.openshift-helper/logs')
+        parser.add_argument('--answers', action='store')
+        parser.add_argument('--prom-dir', action='store')
+        self.args = parser.parse_args()
+        self.templateList = self.args.templates
+        self.parallel = max(1, self.args.parallel)
+        self.baseDir = self.args.dir
+        self.logDir = self.args.logs
+        self.answerDir = self.args.answers
+        self.promDir = self.args.prom_dir
+
+def main():
+    clusterBuilder()
+
+if __name__ == '__main__':
+
+    try:
+        main()
+    except SystemExit as e:
+        if e.code == 0:
+            os._exit(0)
+        else:
+            os._exit(e.code)
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+
+'''
+Approve Node CSRs and Wait for Cluster Nodes to Become Healthy
+'''
+
+import os
+import sys
+import argparse
+import json
+import base64
+import ssl
+import tempfile
+import threading
+import queue
+import time
+import datetime
+import http.client
+import urllib.parse
+import concurrent.futures
+
+class kubeClient(object):
+    '''
+    Minimal Kubernetes API client using the current context of a kubeconfig file.
+    Plain http servers are allowed so the client can run against a local stub.
+    '''
+
+    def __init__(self, kubeconfig, timeout = 30):
+        import yaml
+
+        self.timeout = timeout
+        self.token = None
+        self.sslContext = None
+
+        with open(kubeconfig, 'r') as configFile:
+            config = yaml.safe_load(configFile)
+
+        contextName = config.get('current-context')
+        context = self.findEntry(config.get('contexts', []), contextName)['context']
+        cluster = self.findEntry(config.get('clusters', []), context['cluster'])['cluster']
+        user = self.findEntry(config.get('users', []), context['user'])['user']
+
+        self.server = urllib.parse.urlparse(cluster['server'])
+
+        if self.server.scheme == 'https':
+            self.sslContext = ssl.create_default_context()
+            if cluster.get('insecure-skip-tls-verify'):
+                self.sslContext.check_hostname = False
+                self.sslContext.verify_mode = ssl.CERT_NONE
+            elif 'certificate-authority-data' in cluster:
+                self.sslContext.load_verify_locations(cadata=base64.b64decode(cluster['certificate-authority-data']).decode('ascii'))
+            elif 'certificate-authority' in cluster:
+                self.sslContext.load_verify_locations(cafile=cluster['certificate-authority'])
+            if 'client-certificate-data' in user:
+                self.loadClientCert(base64.b64decode(user['client-certificate-data']),
+                                    base64.b64decode(user['client-key-data']))
+            elif 'client-certificate' in user:
+                self.sslContext.load_cert_chain(user['client-certificate'], user['client-key'])
+
+        if 'token' in user:
+            self.token = user['token']
+
+    def findEntry(self, entryList, name):
+        for entry in entryList:
+            if entry.get('name') == name:
+                return entry
+        raise ValueError("kubeconfig entry %s not found" % name)
+
+    def loadClientCert(self, certData, keyData):
+        # The ssl module only loads certificate chains from files
+        certDir = tempfile.mkdtemp()
+        try:
+            certFile = certDir + '/client.crt'
+            keyFile = certDir + '/client.key'
+            for fileName, fileData in [(certFile, certData), (keyFile, keyData)]:
+                fileFd = os.open(fileName, os.O_WRONLY | os.O_CREAT, 0o600)
+                with os.fdopen(fileFd, 'wb') as pemFile:
+                    pemFile.write(fileData)
+            self.sslContext.load_cert_chain(certFile, keyFile)
+        finally:
+            for fileName in os.listdir(certDir):
+                os.remove(certDir + '/' + fileName)
+            os.rmdir(certDir)
+
+    def connection(self, timeout = None):
+        if timeout is None:
+            timeout = self.timeout
+        if self.server.scheme == 'https':
+            return http.client.HTTPSConnection(self.server.hostname, self.server.port or 443, timeout=timeout, context=self.sslContext)
+        return http.client.HTTPConnection(self.server.hostname, self.server.port or 80, timeout=timeout)
+
+    def headers(self):
+        headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
+        if self.token:
+            headers['Authorization'] = 'Bearer ' + self.token
+        return headers
+
+    def request(self, method, path, body = None):
+        conn = self.connection()
+        try:
+            conn.request(method, self.server.path.rstrip('/') + path,
+                         body=json.dumps(body) if body is not None else None,
+                         headers=self.headers())
+            response = conn.getresponse()
+            data = response.read()
+        finally:
+            conn.close()
+
+        return response.status, data
+
+    def getJson(self, path):
+        status, data = self.request('GET', path)
+        if status != 200:
+            raise RuntimeError("GET %s returned %d" % (path, status))
+        return json.loads(data)
+
+    def watch(self, path, resourceVersion, timeoutSeconds = 300):
+        query = urllib.parse.urlencode({'watch': '1',
+                                        'resourceVersion': resourceVersion,
+                                        'allowWatchBookmarks': 'true',
+                                        'timeoutSeconds': timeoutSeconds})
+        conn = self.connection(timeout=timeoutSeconds + 30)
+        try:
+            conn.request('GET', self.server.path.rstrip('/') + path + '?' + query, headers=self.headers())
+            response = conn.getresponse()
+            if response.status != 200:
+                raise RuntimeError("watch %s returned %d" % (path, response.status))
+            while True:
+                line = response.readline()
+                if not line:
+                    break
+                if line.strip():
+                    yield json.loads(line)
+        finally:
+            conn.close()
+
+class csrApprover(object):
+
+    def __init__(self):
+        self.parse_args()
+
+        if not self.kubeconfig:
+            print("A kubeconfig file is required.")
+            sys.exit(1)
+
+        try:
+            self.client = kubeClient(self.kubeconfig)
+        except (OSError, ValueError, KeyError) as e:
+            print("Can not load kubeconfig: %s" % str(e))
+            sys.exit(1)
+
+        self.csrPath = '/apis/certificates.k8s.io/' + self.csrApiVersion + '/certificatesigningrequests'
+        self.nodePath = '/api/v1/nodes'
+        self.events = queue.Queue()
+        self.stopEvent = threading.Event()
+        self.nodes = {}
+        self.healthy = {}
+        self.lastCheck = {}
+        self.pendingChecks = {}
+        self.approved = set()
+
+        if not self.run():
+            print("Timeout waiting for nodes to become healthy.")
+            sys.exit(1)
+        print("Done.")
+
+    def watchLoop(self, kind, path):
+        while not self.stopEvent.is_set():
+            try:
+                listing = self.client.getJson(path)
+                resourceVersion = listing['metadata']['resourceVersion']
+                for item in listing.get('items', []):
+                    self.events.put((kind, 'ADDED', item))
+                for event in self.client.watch(path, resourceVersion):
+                    if self.stopEvent.is_set():
+                        return
+                    if event['type'] == 'ERROR':
+                        # Usually 410 Gone, list again to get a current resource version
+                        break
+                    resourceVersion = event['object']['metadata']['resourceVersion']
+                    if event['type'] in ('ADDED', 'MODIFIED', 'DELETED'):
+                        self.events.put((kind, event['type'], event['object']))
+            except Exception as e:
+                if self.stopEvent.is_set():
+                    return
+                print("Watch on %s failed: %s" % (path, str(e)))
+                time.sleep(2)
+
+    def csrPending(self, csr):
+        return not csr.get('status', {}).get('conditions')
+
+    def approveCsr(self, csr):
+        name = csr['metadata']['name']
+        now = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        condition = {}
+        condition['type'] = 'Approved'
+        condition['status'] = 'True'
+        condition['reason'] = 'NodeCSRApprove'
+        condition['message'] = 'Approved by csrApprover.py'
+        condition['lastUpdateTime'] = now
+        csr.setdefault('status', {})['conditions'] = [condition]
+
+        status, data = self.client.request('PUT', self.csrPath + '/' + name + '/approval', csr)
+        if status == 200:
+            self.approved.add(name)
+            print("Approved CSR %s" % name)
+        elif status != 409:
+            # A conflict means the CSR changed, the watch delivers the new version
+            print("Can not approve CSR %s: HTTP %d" % (name, status))
+
+    def checkHealth(self, name):
+        try:
+            status, data = self.client.request('GET', self.nodePath + '/' + name + '/proxy/healthz')
+        except Exception:
+            return False
+        return status == 200 and data.strip() == b'ok'
+
+    def isWorker(self, node):
+        labels = node['metadata'].get('labels', {})
+        return 'node-role.kubernetes.io/worker' in labels or 'worker' in node['metadata']['name']
+
+    def clusterReady(self):
+        workerCount = len([node for node in self.nodes.values() if self.isWorker(node)])
+        if workerCount < self.workerCount:
+            return False
+        return all([self.healthy.get(name) for name in self.nodes])
+
+    def run(self):
+        deadline = time.time() + self.timeout
+        watchers = []
+
+        for kind, path in [('csr', self.csrPath), ('node', self.nodePath)]:
+            watcher = threading.Thread(target=self.watchLoop, args=(kind, path), daemon=True)
+            watcher.start()
+            watchers.append(watcher)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.healthThreads) as executor:
+            try:
+                while time.time() < deadline:
+                    try:
+                        kind, eventType, obj = self.events.get(timeout=0.5)
+                    except queue.Empty:
+                        kind, eventType, obj = None, None, None
+
+                    if kind == 'csr' and eventType != 'DELETED' and self.csrPending(obj) and obj['metadata']['name'] not in self.approved:
+                        self.approveCsr(obj)
+                    elif kind == 'node':
+                        name = obj['metadata']['name']
+                        self.nodes[name] = obj
+                        if eventType == 'DELETED':
+                            del self.nodes[name]
+                        elif name not in self.pendingChecks:
+                            # A node event triggers an immediate check
+                            self.lastCheck[name] = 0
+
+                    for name, future in list(self.pendingChecks.items()):
+                        if future.done():
+                            self.healthy[name] = future.result()
+                            del self.pendingChecks[name]
+
+                    # Only nodes that are not healthy yet are checked again, all in parallel
+                    for name in self.nodes:
+                        if not self.healthy.get(name) and name not in self.pendingChecks \
+                                and time.time() - self.lastCheck.get(name, 0) >= self.recheckInterval:
+                            self.lastCheck[name] = time.time()
+                            self.pendingChecks[name] = executor.submit(self.checkHealth, name)
+
+                    if self.nodes and self.clusterReady():
+                        return True
+            finally:
+                self.stopEvent.set()
+
+        return False
+
+    def parse_args(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--kubeconfig', action='store', default=os.environ.get('KUBECONFIG'))
+        parser.add_argument('--worker-count', action='store', type=int, default=0)
+        parser.add_argument('--timeout', action='store', type=int, default=3600)
+        parser.add_argument('--recheck', action='store', type=float, default=5.0)
+        parser.add_argument('--threads', action='store', type=int, default=16)
+        parser.add_argument('--csr-api', action='store', default='v1')
+        self.args = parser.parse_args()
+        self.kubeconfig = self.args.kubeconfig
+        self.workerCount = self.args.worker_count
+        self.timeout = self.args.timeout
+        self.recheckInterval = self.args.recheck
+        self.healthThreads = self.args.threads
+        self.csrApiVersion = self.args.csr_api
+
+def main():
+    csrApprover()
+
+if __name__ == '__main__':
+
+    try:
+        main()
+    except SystemExit as e:
+        if e.code == 0:
+            os._exit(0)
+        else:
+            os._exit(e.code)
@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+
+'''
+Check csrApprover.py Against a Stub Kubernetes API
+'''
+
+import os
+import sys
+import argparse
+import subprocess
+import threading
+import time
+import json
+import tempfile
+import shutil
+import http.server
+import urllib.parse
+
+CSR_PATH = '/apis/certificates.k8s.io/v1/certificatesigningrequests'
+NODE_PATH = '/api/v1/nodes'
+STUB_TOKEN = 'csr-bench-token'
+
+class stubApi(object):
+    '''
+    In-memory CSR and node API with list, watch, approval and node health.
+    Approving the client CSR of a worker adds its node and a serving CSR, and
+    the node reports healthy once the serving CSR is approved as well.
+    '''
+
+    def __init__(self, workerCount, masterCount = 3):
+        self.workerCount = workerCount
+        self.lock = threading.Condition()
+        self.resourceVersion = 0
+        self.objects = {'csr': {}, 'node': {}}
+        self.events = []
+        self.approvals = {}
+        self.csrNode = {}
+        self.stopped = False
+        self.server = None
+
+        for n in range(masterCount):
+            self.addNode('master-%d' % n, 'master', True)
+
+    def nextVersion(self):
+        self.resourceVersion += 1
+        return str(self.resourceVersion)
+
+    def putObject(self, kind, obj, eventType):
+        with self.lock:
+            obj['metadata']['resourceVersion'] = self.nextVersion()
+            self.objects[kind][obj['metadata']['name']] = obj
+            self.events.append((self.resourceVersion, kind, {'type': eventType, 'object': obj}))
+            self.lock.notify_all()
+
+    def addCsr(self, name, nodeName, serving):
+        csr = {}
+        csr['metadata'] = {'name': name}
+        if serving:
+            csr['spec'] = {'username': 'system:node:' + nodeName, 'signerName': 'kubernetes.io/kubelet-serving'}
+        else:
+            csr['spec'] = {'username': 'system:serviceaccount:openshift-machine-config-operator:node-bootstrapper',
+                           'signerName': 'kubernetes.io/kube-apiserver-client-kubelet'}
+        csr['status'] = {}
+        self.csrNode[name] = (nodeName, serving)
+        self.putObject('csr', csr, 'ADDED')
+
+    def addNode(self, name, role, ready = False):
+        node = {}
+        node['metadata'] = {'name': name, 'labels': {'node-role.kubernetes.io/' + role: ''}}
+        node['status'] = {'ready': ready}
+        self.putObject('node', node, 'ADDED')
+
+    def addWorkerCsrs(self, first, last, delay = 0):
+        for n in range(first, last):
+            if self.stopped:
+                return
+            self.addCsr('csr-client-%d' % n, 'worker-%d' % n, False)
+            time.sleep(delay)
+
+    def approve(self, name, body):
+        conditions = body.get('status', {}).get('conditions', [])
+        if name not in self.objects['csr'] or not [c for c in conditions if c.get('type') == 'Approved']:
+            return 404 if name not in self.objects['csr'] else 422
+
+        with self.lock:
+            self.approvals[name] = self.approvals.get(name, 0) + 1
+            if self.approvals[name] > 1:
+                return 200
+        csr = dict(self.objects['csr'][name])
+        csr['status'] = {'conditions': conditions}
+        self.putObject('csr', csr, 'MODIFIED')
+
+        nodeName, serving = self.csrNode[name]
+        if serving:
+            node = dict(self.objects['node'][nodeName])
+            node['status'] = {'ready': True}
+            self.putObject('node', node, 'MODIFIED')
+        else:
+            self.addNode(nodeName, 'worker')
+            self.addCsr('csr-serving-' + nodeName.split('-')[-1], nodeName, True)
+        return 200
+
+    def listing(self, kind):
+        with self.lock:
+            items = list(self.objects[kind].values())
+            return {'metadata': {'resourceVersion': str(self.resourceVersion)}, 'items': items}
+
+    def healthy(self, name):
+        node = self.objects['node'].get(name)
+        return node is not None and node['status'].get('ready')
+
+    def approvedCount(self):
+        return len([csr for csr in self.objects['csr'].values() if csr['status'].get('conditions')])
+
+    def workerNodes(self):
+        return len([name for name in self.objects['node'] if name.startswith('worker-')])
+
+    def start(self):
+        stub = self
+
+        class stubHandler(http.server.BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def reply(self, status, data, contentType = 'application/json'):
+                body = data if isinstance(data, bytes) else json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', contentType)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def authorized(self):
+                if self.headers.get('Authorization') != 'Bearer ' + STUB_TOKEN:
+                    self.reply(401, {'kind': 'Status', 'code': 401})
+                    return False
+                return True
+
+            def watchStream(self, kind, query):
+                resourceVersion = int(query.get('resourceVersion', ['0'])[0])
+                deadline = time.time() + int(query.get('timeoutSeconds', ['300'])[0])
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                try:
+                    while time.time() < deadline:
+                        with stub.lock:
+                            stub.lock.wait_for(lambda: stub.stopped or stub.events[-1][0] > resourceVersion, timeout=1)
+                            if stub.stopped:
+                                return
+                            eventList = [event for version, eventKind, event in stub.events
+                                         if version > resourceVersion and eventKind == kind]
+                            resourceVersion = stub.resourceVersion
+                        for event in eventList:
+                            self.wfile.write(json.dumps(event).encode('utf-8') + b"\n")
+                        self.wfile.flush()
+                except OSError:
+                    # The approver exited with the watch still open
+                    return
+
+            def do_GET(self):
+                if not self.authorized():
+                    return
+                url = urllib.parse.urlparse(self.path)
+                query = urllib.parse.parse_qs(url.query)
+                kind = {CSR_PATH: 'csr', NODE_PATH: 'node'}.get(url.path)
+                if kind and query.get('watch'):
+                    self.watchStream(kind, query)
+                elif kind:
+                    self.reply(200, stub.listing(kind))
+                elif url.path.startswith(NODE_PATH + '/') and url.path.endswith('/proxy/healthz'):
+                    name = url.path[len(NODE_PATH) + 1:-len('/proxy/healthz')]
+                    if stub.healthy(name):
+                        self.reply(200, b'ok', 'text/plain')
+                    else:
+                        self.reply(500, b'[-]kubelet not ready', 'text/plain')
+                else:
+                    self.reply(404, {'kind': 'Status', 'code': 404})
+
+            def do_PUT(self):
+                if not self.authorized():
+                    return
+                url = urllib.parse.urlparse(self.path)
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                if url.path.startswith(CSR_PATH + '/') and url.path.endswith('/approval'):
+                    status = stub.approve(url.path[len(CSR_PATH) + 1:-len('/approval')], body)
+                    self.reply(status, body)
+                else:
+                    self.reply(404, {'kind': 'Status', 'code': 404})
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), stubHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self.lock.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+class csrBench(object):
+    '''
+    Run csrApprover.py against the stub. Half of the client CSRs are in the first
+    listing and the rest arrive through the watch. The approver must approve every
+    client and serving CSR once and exit when the worker count is reached, and must
+    time out when fewer workers than requested join.
+    '''
+
+    def __init__(self):
+        self.parse_args()
+        self.scriptDir = os.path.dirname(os.path.abspath(__file__))
+
+        failed = False
+        for label, expectedCount in [('approve', self.workerCount), ('short', self.workerCount + 1)]:
+            problems = self.runCase(expectedCount)
+            print("CSR %-10s %s" % (label, '; '.join(problems) if problems else 'ok'))
+            failed = failed or bool(problems)
+
+        if failed:
+            sys.exit(1)
+
+    def writeKubeconfig(self, fileName, server):
+        # JSON is valid YAML, so the approver reads this like any kubeconfig
+        config = {}
+        config['apiVersion'] = 'v1'
+        config['kind'] = 'Config'
+        config['current-context'] = 'stub'
+        config['clusters'] = [{'name': 'stub', 'cluster': {'server': server}}]
+        config['users'] = [{'name': 'stub', 'user': {'token': STUB_TOKEN}}]
+        config['contexts'] = [{'name': 'stub', 'context': {'cluster': 'stub', 'user': 'stub'}}]
+        with open(fileName, 'w') as configFile:
+            json.dump(config, configFile)
+
+    def runCase(self, expectedCount):
+        stub = stubApi(self.workerCount)
+        stub.addWorkerCsrs(0, self.workerCount // 2)
+        caseDir = tempfile.mkdtemp(prefix='csrbench-')
+        problems = []
+        try:
+            kubeconfig = caseDir + '/kubeconfig'
+            self.writeKubeconfig(kubeconfig, stub.start())
+            feeder = threading.Thread(target=stub.addWorkerCsrs, args=(self.workerCount // 2, self.workerCount, 0.02), daemon=True)
+            feeder.start()
+
+            command = [sys.executable, self.scriptDir + '/csrApprover.py', '--kubeconfig', kubeconfig,
+                       '--worker-count', str(expectedCount), '--timeout', str(self.timeout), '--recheck', '0.2']
+            start = time.time()
+            try:
+                result = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                        universal_newlines=True, timeout=self.timeout + 30)
+            except subprocess.TimeoutExpired:
+                return ["approver did not exit"]
+            elapsed = time.time() - start
+
+            if expectedCount <= self.workerCount:
+                if result.returncode != 0:
+                    problems.append("exit code %d: %s" % (result.returncode, result.stderr.strip() or result.stdout.strip()))
+                if stub.approvedCount() != 2 * self.workerCount:
+                    problems.append("%d of %d CSRs approved" % (stub.approvedCount(), 2 * self.workerCount))
+                if stub.workerNodes() < expectedCount:
+                    problems.append("exited with %d of %d workers" % (stub.workerNodes(), expectedCount))
+            else:
+                if result.returncode != 1:
+                    problems.append("exit code %d instead of 1 with too few workers" % result.returncode)
+                if elapsed < self.timeout:
+                    problems.append("exited after %.1f s, before the %d s timeout" % (elapsed, self.timeout))
+            repeated = sorted([name for name, count in stub.approvals.items() if count > 1])
+            if repeated:
+                problems.append("approved more than once: %s" % ' '.join(repeated))
+        finally:
+            stub.stop()
+            shutil.rmtree(caseDir, ignore_errors=True)
+
+        return problems
+
+    def parse_args(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--worker-count', action='store', type=int, default=20)
+        parser.add_argument('--timeout', action='store', type=int, default=10)
+        self.args = parser.parse_args()
+        self.workerCount = self.args.worker_count
+        self.timeout = self.args.timeout
+
+def main():
+    csrBench()
+
+if __name__ == '__main__':
+
+    try:
+        main()
+    except SystemExit as e:
+        if e.code == 0:
+            os._exit(0)
+        else:
+            os._exit(e.code)
@@ -8,8 +8,19 @@ CFGDIR=${BASEDIR}/${ENVNAME}
 RUNSTEP=1
 SCRIPTDIR=$(cd $(dirname $0) && pwd)
 PKGROOT=$(dirname $SCRIPTDIR)
+TFDIR=${PKGROOT}/terraform/env/${ENVNAME}
 TEMPLATE="install-config-template.yaml"
-PRINT_USAGE="Usage: $0 [ -s | -c | -e env_name | -d dir | -t template | -w | -r | -b | -g ]"
+TEMPLATE_FILE=${HOME}/${TEMPLATE}
+IGN_URL=""
+IGN_COMPRESS=""
+IGN_SERVER_PID=""
+NSX=0
+NSX_DIR=""
+TRACE_FILE=""
+PROM_FILE=""
+CURRENT_PHASE=""
+PHASE_START=""
+PRINT_USAGE="Usage: $0 [ -s | -c | -e env_name | -d dir | -t template_file | -u ignition_url | -z | -w | -r | -b | -g | -a | -m prom_file | -n ]"
 
 function print_usage {
 if [ -n "$PRINT_USAGE" ]; then
@@ -32,32 +43,39 @@ function get_rhcos {
 which ansible-helper.py >/dev/null 2>&1
 [ $? -ne 0 ] && err_exit "Ansible Helper is required for this operation."
 
-vsphere_cluster=$($SCRIPTDIR/tfConfig.py --get platform.vsphere.cluster --yaml ${HOME}/${TEMPLATE})
-[ $? -ne 0 ] && err_exit "Can not get cluster parameter from ${HOME}/${TEMPLATE}."
-vsphere_datacenter=$($SCRIPTDIR/tfConfig.py --get platform.vsphere.datacenter --yaml ${HOME}/${TEMPLATE})
-[ $? -ne 0 ] && err_exit "Can not get datacenter parameter from ${HOME}/${TEMPLATE}."
-vsphere_datastore=$($SCRIPTDIR/tfConfig.py --get platform.vsphere.defaultDatastore --yaml ${HOME}/${TEMPLATE})
-[ $? -ne 0 ] && err_exit "Can not get datastore parameter from ${HOME}/${TEMPLATE}."
-vsphere_username=$($SCRIPTDIR/tfConfig.py --get platform.vsphere.username --yaml ${HOME}/${TEMPLATE})
-[ $? -ne 0 ] && err_exit "Can not get username parameter from ${HOME}/${TEMPLATE}."
-vsphere_password=$($SCRIPTDIR/tfConfig.py --get platform.vsphere.password --yaml ${HOME}/${TEMPLATE})
-[ $? -ne 0 ] && err_exit "Can not get password parameter from ${HOME}/${TEMPLATE}."
-vsphere_host=$($SCRIPTDIR/tfConfig.py --get platform.vsphere.vCenter --yaml ${HOME}/${TEMPLATE})
-[ $? -ne 0 ] && err_exit "Can not get host parameter from ${HOME}/${TEMPLATE}."
-vsphere_network=$($SCRIPTDIR/tfConfig.py --get platform.vsphere.network --yaml ${HOME}/${TEMPLATE})
-[ $? -ne 0 ] && err_exit "Can not get host parameter from ${HOME}/${TEMPLATE}."
+VSPHERE_VARS=$($SCRIPTDIR/tfConfig.py --yaml ${TEMPLATE_FILE} --format shell \
+                --get vsphere_cluster=platform.vsphere.cluster \
+                      vsphere_datacenter=platform.vsphere.datacenter \
+                      vsphere_datastore=platform.vsphere.defaultDatastore \
+                      vsphere_username=platform.vsphere.username \
+                      vsphere_password=platform.vsphere.password \
+                      vsphere_host=platform.vsphere.vCenter \
+                      vsphere_network=platform.vsphere.network)
+[ $? -ne 0 ] && err_exit "Can not get vSphere parameters from ${TEMPLATE_FILE}."
+eval "$VSPHERE_VARS"
+
+echo "Downloading RHCOS OVA ..."
+OVA_VARS=$($SCRIPTDIR/rhcosFetch.py --dest $BASEDIR/.rhcos/rhcos-vmware.x86_64.ova --yaml ${TEMPLATE_FILE} --format shell)
+[ $? -ne 0 ] && err_exit "Can not download RHCOS OVA."
+eval "$OVA_VARS"
+
+if [ "$template_current" = "yes" ]; then
+  echo "RHCOS template is up to date."
+  exit
+fi
 
 export HELPER_PATH=$PKGROOT/playbooks
-echo -n "Downloading RHCOS OVA ... "
+echo -n "Importing RHCOS template ... "
 ansible-helper.py create-rhcos-template.yaml --vmware_host $vsphere_host \
                                              --vmware_user $vsphere_username \
                                              --vsphere_password $vsphere_password \
                                              --vmware_dc $vsphere_datacenter \
                                              --vmware_ds $vsphere_datastore \
                                              --vmware_cluster $vsphere_cluster \
-                                             --vmware_network $vsphere_network
+                                             --vmware_network $vsphere_network \
+                                             --ova_sha256 $ova_sha256
 if [ $? -ne 0 ]; then
-  err_exit "Can not download RHCOS OVA."
+  err_exit "Can not create RHCOS template."
 else
   echo "Done."
 fi
@@ -77,17 +95,89 @@ exit
 function create_template {
 [ ! -d ${CFGDIR} ] && mkdir ${CFGDIR}
 openshift-install create install-config --dir=${CFGDIR}
-cp ${CFGDIR}/install-config.yaml ${HOME}/${TEMPLATE}
+cp ${CFGDIR}/install-config.yaml ${TEMPLATE_FILE}
 exit
 }
 
+function set_env_dirs {
+CFGDIR=${BASEDIR}/${ENVNAME}
+TFDIR=${PKGROOT}/terraform/env/${ENVNAME}
+if [ "$NSX" -eq 1 ]; then
+  NSX_DIR=${PKGROOT}/nsxt/env/${ENVNAME}
+fi
+}
+
+function prep_tf_workspace {
+[ ! -d ${TFDIR} ] && mkdir -p ${TFDIR}
+# Module files are shared, variables, state and plugins are kept per environment
+for tf_file in ${PKGROOT}/terraform/*.tf ${PKGROOT}/terraform/*.tmpl
+do
+  ln -sf $tf_file ${TFDIR}/$(basename $tf_file)
+done
+[ -z "$NSX_DIR" ] && return
+[ ! -d ${NSX_DIR} ] && mkdir -p ${NSX_DIR}
+for tf_file in ${PKGROOT}/nsxt/*.tf
+do
+  ln -sf $tf_file ${NSX_DIR}/$(basename $tf_file)
+done
+}
+
 function destroy_cluster {
-cd ${PKGROOT}/terraform
+cd ${TFDIR}
 terraform destroy
 cd ${PKGROOT}
 exit
 }
 
+function start_ign_server {
+[ -z "$IGN_URL" ] && return
+$SCRIPTDIR/tfConfig.py --serve --install ${CFGDIR} --ign-url $IGN_URL > ${CFGDIR}/ignition-server.log 2>&1 &
+IGN_SERVER_PID=$!
+}
+
+function stop_ign_server {
+[ -n "$IGN_SERVER_PID" ] && kill $IGN_SERVER_PID 2>/dev/null
+IGN_SERVER_PID=""
+}
+
+function add_workers {
+$SCRIPTDIR/tfConfig.py --add-workers --dir ${TFDIR} --install ${CFGDIR} ${IGN_URL:+--ign-url $IGN_URL} $IGN_COMPRESS
+[ $? -ne 0 ] && err_exit "Can not add workers to the Terraform variables file."
+start_ign_server
+cd ${TFDIR}
+terraform apply -auto-approve
+cd ${PKGROOT}
+NUM_WORKERS=$($SCRIPTDIR/tfConfig.py --get worker_count --dir ${TFDIR})
+$SCRIPTDIR/csrApprover.py --kubeconfig ${CFGDIR}/auth/kubeconfig --worker-count $NUM_WORKERS --timeout 3600
+stop_ign_server
+exit
+}
+
+function phase_start {
+CURRENT_PHASE=$1
+PHASE_START=$(date +%s.%N)
+}
+
+function phase_end {
+local status=${1:-0}
+local phase_end_time
+[ -z "$CURRENT_PHASE" ] && return
+if [ -n "$TRACE_FILE" ]; then
+  phase_end_time=$(date +%s.%N)
+  awk -v phase="$CURRENT_PHASE" -v start="$PHASE_START" -v end="$phase_end_time" -v status="$status" \
+    'BEGIN { printf "{\"source\": \"prepOpenShift.sh\", \"phase\": \"%s\", \"start\": %.6f, \"end\": %.6f, \"duration\": %.6f, \"status\": %d}\n", phase, start, end, end - start, status }' >> $TRACE_FILE
+fi
+CURRENT_PHASE=""
+}
+
+function on_exit {
+phase_end 1
+stop_ign_server
+if [ -n "$TRACE_FILE" ] && [ -f "$TRACE_FILE" ]; then
+  $SCRIPTDIR/tfConfig.py --trace $TRACE_FILE --trace-report --cluster $ENVNAME ${PROM_FILE:+--prom $PROM_FILE}
+fi
+}
+
 function ask_step_continue {
 while true
 do
@@ -109,7 +199,7 @@ function destroy_bootstrap {
 ask_step_continue "Remove bootstrap node?"
 
 if [ "$RUNSTEP" -eq 1 ]; then
-  cd ${PKGROOT}/terraform
+  cd ${TFDIR}
   terraform destroy -target vsphere_virtual_machine.bootstrap_node -auto-approve
   cd ${PKGROOT}
 fi
@@ -122,11 +212,23 @@ if [ $? -ne 0 ]; then
    exit 1
 fi
 
-while getopts "sce:d:t:wrbg" opt
+trap on_exit EXIT
+
+while getopts "sce:d:t:u:zwrbgam:n" opt
 do
   case $opt in
     t)
       TEMPLATE=$OPTARG
+      case $TEMPLATE in
+        /*) TEMPLATE_FILE=$TEMPLATE ;;
+        *) TEMPLATE_FILE=${HOME}/${TEMPLATE} ;;
+      esac
+      ;;
+    u)
+      IGN_URL=$OPTARG
+      ;;
+    z)
+      IGN_COMPRESS="--compress"
       ;;
     c)
       create_template
@@ -136,10 +238,11 @@ do
       ;;
     e)
       ENVNAME=$OPTARG
+      set_env_dirs
       ;;
     d)
       BASEDIR=$OPTARG
-      CFGDIR=${BASEDIR}/${ENVNAME}
+      set_env_dirs
       ;;
     w)
       wipe_install_dir
@@ -153,6 +256,16 @@ do
     g)
       get_rhcos
       ;;
+    a)
+      add_workers
+      ;;
+    m)
+      PROM_FILE=$OPTARG
+      ;;
+    n)
+      NSX=1
+      set_env_dirs
+      ;;
     \?)
       print_usage
       exit 1
@@ -160,25 +273,32 @@ do
   esac
 done
 
+[ ! -d ${CFGDIR} ] && mkdir -p ${CFGDIR}
+prep_tf_workspace
+TRACE_FILE=${CFGDIR}/trace-${DATE}.jsonl
+
 [ "$STEP" -eq 1 ] && ask_step_continue "Copy install template?"
 
 if [ "$RUNSTEP" -eq 1 ]; then
-  if [ ! -f ${HOME}/${TEMPLATE} ]; then
-    echo "Can not find template file ${TEMPLATE}"
+  phase_start copy_config
+  if [ ! -f ${TEMPLATE_FILE} ]; then
+    echo "Can not find template file ${TEMPLATE_FILE}"
     exit 1
   fi
   echo -n "Copying install config to install directory ... "
-  cp ${HOME}/${TEMPLATE} ${CFGDIR}/install-config.yaml && cp ${HOME}/${TEMPLATE} ${CFGDIR}/.install-config-copy.yaml
+  cp ${TEMPLATE_FILE} ${CFGDIR}/install-config.yaml && cp ${TEMPLATE_FILE} ${CFGDIR}/.install-config-copy.yaml
   if [ $? -ne 0 ]; then
     echo "Could not copy install config file."
     exit 1
   fi
   echo "Done."
+  phase_end
 fi
 
 [ "$STEP" -eq 1 ] && ask_step_continue "Create manifests?"
 
 if [ "$RUNSTEP" -eq 1 ]; then
+  phase_start create_manifests
   echo "Creating manifests ..."
   openshift-install create manifests --dir=${CFGDIR}
   if [ $? -ne 0 ]; then
@@ -186,11 +306,13 @@ if [ "$RUNSTEP" -eq 1 ]; then
     exit 1
   fi
   echo "Done."
+  phase_end
 fi
 
 [ "$STEP" -eq 1 ] && ask_step_continue "Remove IPI machine files?"
 
 if [ "$RUNSTEP" -eq 1 ]; then
+  phase_start remove_machine_files
   echo -n "Removing IPI machine files ..."
   rm -f ${CFGDIR}/openshift/99_openshift-cluster-api_master-machines-*.yaml ${CFGDIR}/openshift/99_openshift-cluster-api_worker-machineset-*.yaml
   if [ $? -ne 0 ]; then
@@ -198,11 +320,13 @@ if [ "$RUNSTEP" -eq 1 ]; then
     exit 1
   fi
   echo "Done."
+  phase_end
 fi
 
 [ "$STEP" -eq 1 ] && ask_step_continue "Edit cluster-scheduler-02-config.yml?"
 
 if [ "$RUNSTEP" -eq 1 ]; then
+  phase_start edit_scheduler
   echo -n "Editing cluster-scheduler-02-config.yml ..."
   sed -i -e 's/mastersSchedulable: true/mastersSchedulable: false/' ${CFGDIR}/manifests/cluster-scheduler-02-config.yml
   if [ $? -ne 0 ]; then
@@ -210,11 +334,13 @@ if [ "$RUNSTEP" -eq 1 ]; then
     exit 1
   fi
   echo "Done."
+  phase_end
 fi
 
 [ "$STEP" -eq 1 ] && ask_step_continue "Creating ignition configs?"
 
 if [ "$RUNSTEP" -eq 1 ]; then
+  phase_start create_ignition
   echo "Creating ignition configs..."
   openshift-install create ignition-configs --dir=${CFGDIR}
   if [ $? -ne 0 ]; then
@@ -222,36 +348,55 @@ if [ "$RUNSTEP" -eq 1 ]; then
     exit 1
   fi
   echo "Done."
+  phase_end
 fi
 
 [ "$STEP" -eq 1 ] && ask_step_continue "Generate Terraform variables file?"
 
 if [ "$RUNSTEP" -eq 1 ]; then
+  phase_start generate_variables
   INFRA_ID=$(jq -r .infraID ${CFGDIR}/metadata.json)
-  $SCRIPTDIR/tfConfig.py --file ${CFGDIR}/.install-config-copy.yaml --dir ${PKGROOT}/terraform --install ${CFGDIR} --id $INFRA_ID --template $BASEDIR/.rhcos/rhcos-vmware.x86_64.ova --dual
+  $SCRIPTDIR/tfConfig.py --file ${CFGDIR}/.install-config-copy.yaml --dir ${TFDIR} --install ${CFGDIR} --id $INFRA_ID --template $BASEDIR/.rhcos/rhcos-vmware.x86_64.ova --dual ${IGN_URL:+--ign-url $IGN_URL} $IGN_COMPRESS ${NSX_DIR:+--nsx-dir $NSX_DIR} --trace $TRACE_FILE
   if [ $? -ne 0 ]; then
     echo "Could not create Terraform variables file."
     exit 1
   fi
+  phase_end
 fi
 
 [ "$STEP" -eq 1 ] && ask_step_continue "Create cluster?"
 
+start_ign_server
+
+if [ "$RUNSTEP" -eq 1 ] && [ -n "$NSX_DIR" ]; then
+  cd ${NSX_DIR}
+  phase_start nsx_apply
+  terraform init && terraform apply -auto-approve
+  phase_end $?
+  cd ${PKGROOT}
+fi
+
 if [ "$RUNSTEP" -eq 1 ]; then
-  cd ${PKGROOT}/terraform
+  cd ${TFDIR}
+  phase_start terraform_init
   terraform init
+  phase_end $?
+  phase_start terraform_apply
   terraform apply -auto-approve
+  phase_end $?
   cd ${PKGROOT}
 fi
 
 [ "$STEP" -eq 1 ] && ask_step_continue "Monitor progress?"
 
 if [ "$RUNSTEP" -eq 1 ]; then
+  phase_start wait_bootstrap
   openshift-install --dir=${CFGDIR} wait-for bootstrap-complete --log-level=info
   if [ $? -ne 0 ]; then
     echo "Could not create cluster."
     exit 1
   fi
+  phase_end
 fi
 
 [ "$STEP" -eq 0 ] && sleep 5
@@ -260,39 +405,18 @@ export KUBECONFIG=${CFGDIR}/auth/kubeconfig
 [ "$STEP" -eq 1 ] && ask_step_continue "Approve CSRs?"
 
 if [ "$RUNSTEP" -eq 1 ]; then
-  CONTINUE=1
-  SLEEP_COUNT=0
-  NUM_WORKERS=$($SCRIPTDIR/tfConfig.py --get worker_count --dir ${PKGROOT}/terraform)
-  while [ "$CONTINUE" -eq 1 ]; do
-    CONTINUE=0
-    pendingCount=$(oc get csr | grep "Pending" | wc -l)
-    if [ "$pendingCount" -gt 0 ]; then
-       oc get csr -o go-template='{{range .items}}{{if not .status}}{{.metadata.name}}{{"\n"}}{{end}}{{end}}' | xargs --no-run-if-empty oc adm certificate approve
-    fi
-    actualWorkerCount=$(oc get nodes --no-headers -o=custom-columns=NAME:.metadata.name | grep worker | wc -l)
-    if [ "$actualWorkerCount" -ne "$NUM_WORKERS" ]; then
-       CONTINUE=1
-    fi
-    for node in $(oc get nodes --no-headers -o=custom-columns=NAME:.metadata.name); do
-    	nodeStatus=$(oc get --raw /api/v1/nodes/${node}/proxy/healthz 2>&1)
-    	nodeStatus=$(echo $nodeStatus | sed -e '/^$/d')
-    	if [ "$nodeStatus" != "ok" ]; then
-    	   CONTINUE=1
-    	fi
-    done
-    if [ "$CONTINUE" -eq 0 ]; then
-       break
-    fi
-    if [ "$SLEEP_COUNT" -ge 120 ]; then
-       echo "Timeout waiting for bootstrap to complete."
-       exit 1
-    fi
-    sleep 30
-    SLEEP_COUNT=$((SLEEP_COUNT + 1))
-  done
-echo "Done."
+  phase_start approve_csrs
+  NUM_WORKERS=$($SCRIPTDIR/tfConfig.py --get worker_count --dir ${TFDIR})
+  $SCRIPTDIR/csrApprover.py --kubeconfig ${KUBECONFIG} --worker-count $NUM_WORKERS --timeout 3600
+  if [ $? -ne 0 ]; then
+     echo "Timeout waiting for bootstrap to complete."
+     exit 1
+  fi
+  phase_end
 fi
 
+stop_ign_server
+
 if [ "$STEP" -eq 0 ]; then
   oc get nodes
 fi
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+'''
+Download the RHCOS OVA and Check the vSphere Template Against It
+'''
+
+import os
+import sys
+import argparse
+import json
+import re
+import hashlib
+import time
+import urllib.request
+import urllib.error
+
+RHCOS_URL = 'https://mirror.openshift.com/pub/openshift-v4/dependencies/rhcos/latest/latest/rhcos-vmware.x86_64.ova'
+TEMPLATE_TAG = re.compile(r'rhcos-sha256:([0-9a-f]{64})')
+
+class ovaFetcher(object):
+    '''
+    Fetch a large file with conditional requests (ETag and Last-Modified) and
+    resume an interrupted download with an HTTP Range request. The sha256 of
+    the file is computed while it is written and kept in a metadata file.
+    '''
+
+    def __init__(self, url, destFile, timeout = 60, chunkSize = 1048576, log = print):
+        self.url = url
+        self.destFile = destFile
+        self.partFile = destFile + '.part'
+        self.metaFile = destFile + '.json'
+        self.timeout = timeout
+        self.chunkSize = chunkSize
+        self.log = log
+
+    def loadMeta(self):
+        try:
+            with open(self.metaFile, 'r') as metaInput:
+                return json.load(metaInput)
+        except (OSError, ValueError):
+            return {}
+
+    def saveMeta(self, meta):
+        with open(self.metaFile + '.tmp', 'w') as metaOutput:
+            json.dump(meta, metaOutput, indent=4)
+            metaOutput.write("\n")
+        os.replace(self.metaFile + '.tmp', self.metaFile)
+
+    def hashFile(self, fileName, hasher = None):
+        if not hasher:
+            hasher = hashlib.sha256()
+        with open(fileName, 'rb') as fileInput:
+            while True:
+                block = fileInput.read(self.chunkSize)
+                if not block:
+                    break
+                hasher.update(block)
+        return hasher
+
+    def fetch(self):
+        meta = self.loadMeta()
+        partial = meta.get('partial', {})
+        headers = {}
+        offset = 0
+
+        if partial.get('url') == self.url and os.path.exists(self.partFile) and (partial.get('etag') or partial.get('last_modified')):
+            # If-Range makes the server send the whole file when it changed since the partial download
+            offset = os.path.getsize(self.partFile)
+            headers['Range'] = 'bytes=%d-' % offset
+            headers['If-Range'] = partial.get('etag') or partial.get('last_modified')
+        elif meta.get('url') == self.url and meta.get('sha256') and os.path.exists(self.destFile) \
+                and os.path.getsize(self.destFile) == meta.get('size'):
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        request = urllib.request.Request(self.url, headers=headers)
+        try:
+            response = urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                self.log("%s is current." % os.path.basename(self.destFile))
+                return False, meta['sha256']
+            if e.code == 416:
+                # The partial file is not a prefix of the current file
+                os.remove(self.partFile)
+                del meta['partial']
+                self.saveMeta(meta)
+                return self.fetch()
+            raise
+
+        with response:
+            hasher = hashlib.sha256()
+            if response.status == 206:
+                rangeMatch = re.match(r'bytes (\d+)-\d+/(\d+)', response.headers.get('Content-Range', ''))
+                if not rangeMatch or int(rangeMatch.group(1)) != offset:
+                    raise IOError("unexpected Content-Range %s" % response.headers.get('Content-Range'))
+                self.log("Resuming download at %d bytes." % offset)
+                self.hashFile(self.partFile, hasher)
+                mode = 'ab'
+                total = int(rangeMatch.group(2))
+            else:
+                offset = 0
+                mode = 'wb'
+                total = int(response.headers.get('Content-Length', 0))
+
+            meta['partial'] = {}
+            meta['partial']['url'] = self.url
+            meta['partial']['etag'] = response.headers.get('ETag')
+            meta['partial']['last_modified'] = response.headers.get('Last-Modified')
+            self.saveMeta(meta)
+
+            size = offset
+            start = time.time()
+            with open(self.partFile, mode) as partOutput:
+                while True:
+                    block = response.read(self.chunkSize)
+                    if not block:
+                        break
+                    hasher.update(block)
+                    partOutput.write(block)
+                    size += len(block)
+                partOutput.flush()
+                os.fsync(partOutput.fileno())
+
+        if total and size != total:
+            raise IOError("download ended at %d of %d bytes" % (size, total))
+
+        os.replace(self.partFile, self.destFile)
+        newMeta = {}
+        newMeta['url'] = self.url
+        newMeta['etag'] = meta['partial']['etag']
+        newMeta['last_modified'] = meta['partial']['last_modified']
+        newMeta['size'] = size
+        newMeta['sha256'] = hasher.hexdigest()
+        self.saveMeta(newMeta)
+
+        elapsed = max(time.time() - start, 0.001)
+        self.log("Downloaded %d bytes in %.1f s (%.1f MB/s)." % (size - offset, elapsed, (size - offset) / elapsed / 1048576))
+        return True, newMeta['sha256']
+
+class rhcosFetch(object):
+
+    def __init__(self):
+        self.parse_args()
+
+        if self.outputFormat == 'shell':
+            self.log = lambda message: print(message, file=sys.stderr)
+        else:
+            self.log = print
+
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.destFile)), exist_ok=True)
+        except OSError as e:
+            print("Can not create OVA directory: %s" % str(e))
+            sys.exit(1)
+
+        fetcher = ovaFetcher(self.url, self.destFile, self.timeout, log=self.log)
+        try:
+            changed, sha256 = fetcher.fetch()
+        except (OSError, urllib.error.URLError) as e:
+            self.log("Can not download %s: %s" % (self.url, str(e)))
+            sys.exit(1)
+
+        if self.verify and not changed:
+            if fetcher.hashFile(self.destFile).hexdigest() != sha256:
+                self.log("Checksum of %s does not match, remove it and download again." % self.destFile)
+                sys.exit(1)
+
+        if self.expectSha256 and self.expectSha256.lower() != sha256:
+            self.log("Checksum of %s is %s, expected %s." % (self.destFile, sha256, self.expectSha256))
+            sys.exit(1)
+
+        templateSha256 = None
+        if self.yamlFile:
+            templateSha256 = self.getTemplateSha256()
+        templateCurrent = templateSha256 == sha256
+
+        if templateCurrent:
+            self.log("Template %s was imported from this OVA." % self.templateName)
+
+        if self.outputFormat == 'shell':
+            print("ova_sha256=%s" % sha256)
+            print("ova_changed=%s" % ('yes' if changed else 'no'))
+            print("template_current=%s" % ('yes' if templateCurrent else 'no'))
+        else:
+            self.log("sha256 %s" % sha256)
+
+    def getTemplateSha256(self):
+        import yaml
+        from pyVim.connect import SmartConnectNoSSL, Disconnect
+        from pyVmomi import vim
+
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        from tfConfig import vsphereInventory
+
+        try:
+            with open(self.yamlFile, 'r') as cfgYamlFile:
+                vsphere = yaml.safe_load(cfgYamlFile)['platform']['vsphere']
+        except (OSError, KeyError, TypeError) as e:
+            self.log("Can not read vSphere settings from %s: %s" % (self.yamlFile, str(e)))
+            sys.exit(1)
+
+        try:
+            si = SmartConnectNoSSL(host=vsphere['vCenter'], user=vsphere['username'], pwd=vsphere['password'], port=443)
+        except Exception as e:
+            self.log("Can not connect to vCenter %s: %s" % (vsphere['vCenter'], str(e)))
+            sys.exit(1)
+
+        # The create-rhcos-template playbook records the OVA checksum in the template annotation
+        try:
+            collector = vsphereInventory(si.RetrieveContent())
+            for obj, props in collector.collect(collector.content.rootFolder, vim.VirtualMachine, ['name', 'config.annotation']):
+                if props.get('name') == self.templateName:
+                    match = TEMPLATE_TAG.search(props.get('config.annotation') or '')
+                    return match.group(1) if match else None
+        finally:
+            Disconnect(si)
+
+        return None
+
+    def parse_args(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--url', action='store', default=RHCOS_URL)
+        parser.add_argument('--dest', action='store', default=os.environ.get('HOME', '/var/tmp') + '/.rhcos/rhcos-vmware.x86_64.ova')
+        parser.add_argument('--sha256', action='store')
+        parser.add_argument('--verify', action='store_true')
+        parser.add_argument('--yaml', action='store')
+        parser.add_argument('--template', action='store', default='rhcos-template')
+        parser.add_argument('--timeout', action='store', type=int, default=60)
+        parser.add_argument('--format', action='store', choices=['raw', 'shell'], default='raw')
+        self.args = parser.parse_args()
+        self.url = self.args.url
+        self.destFile = self.args.dest
+        self.expectSha256 = self.args.sha256
+        self.verify = self.args.verify
+        self.yamlFile = self.args.yaml
+        self.templateName = self.args.template
+        self.timeout = self.args.timeout
+        self.outputFormat = self.args.format
+
+def main():
+    rhcosFetch()
+
+if __name__ == '__main__':
+
+    try:
+        main()
+    except SystemExit as e:
+        if e.code == 0:
+            os._exit(0)
+        else:
+            os._exit(e.code)
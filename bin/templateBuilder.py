@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+'''
+Create the RHCOS Bootstrap, Master and Worker Templates in vSphere
+'''
+
+import os
+import sys
+import argparse
+import base64
+import time
+
+class taskWaiter(object):
+    '''
+    Wait for vSphere tasks with a single PropertyCollector WaitForUpdatesEx
+    loop instead of polling each task. Tasks can be added while waiting, for
+    example from the callback of the task they depend on.
+    '''
+
+    def __init__(self, content, timeout = 1800):
+        self.collector = content.propertyCollector.CreatePropertyCollector()
+        self.timeout = timeout
+        self.tasks = {}
+        self.results = []
+
+    def add(self, label, task, callback = None):
+        from pyVmomi import vim, vmodl
+
+        objectSpec = vmodl.query.PropertyCollector.ObjectSpec(obj=task, skip=False)
+        propertySpec = vmodl.query.PropertyCollector.PropertySpec(type=vim.Task, pathSet=['info.state', 'info.error'], all=False)
+        filterSpec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[objectSpec], propSet=[propertySpec])
+
+        entry = {}
+        entry['label'] = label
+        entry['callback'] = callback
+        entry['filter'] = self.collector.CreateFilter(filterSpec, True)
+        entry['start'] = time.time()
+        entry['state'] = None
+        entry['error'] = None
+        self.tasks[task._moId] = entry
+
+    def finish(self, taskId):
+        entry = self.tasks.pop(taskId)
+        entry['filter'].Destroy()
+
+        result = {}
+        result['label'] = entry['label']
+        result['state'] = entry['state']
+        result['error'] = entry['error'].msg if entry['error'] else None
+        result['duration'] = time.time() - entry['start']
+        self.results.append(result)
+
+        print("%s: %s in %.1f s%s" % (result['label'], result['state'], result['duration'],
+                                      ' (%s)' % result['error'] if result['error'] else ''))
+
+        if entry['callback'] and result['state'] == 'success':
+            entry['callback']()
+
+    def wait(self):
+        from pyVmomi import vmodl
+
+        deadline = time.time() + self.timeout
+        version = ''
+
+        try:
+            while self.tasks:
+                remaining = int(deadline - time.time())
+                if remaining <= 0:
+                    raise RuntimeError("timeout waiting for %s" % ', '.join([entry['label'] for entry in self.tasks.values()]))
+                options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=min(remaining, 60))
+                update = self.collector.WaitForUpdatesEx(version, options)
+                if not update:
+                    continue
+                version = update.version
+
+                for filterSet in update.filterSet:
+                    for objectSet in filterSet.objectSet:
+                        entry = self.tasks.get(objectSet.obj._moId)
+                        if not entry:
+                            continue
+                        for change in objectSet.changeSet:
+                            if change.name == 'info.state':
+                                entry['state'] = change.val
+                            elif change.name == 'info.error':
+                                entry['error'] = change.val
+                        if entry['state'] in ('success', 'error'):
+                            self.finish(objectSet.obj._moId)
+        finally:
+            self.collector.Destroy()
+
+        return self.results
+
+class templateBuilder(object):
+
+    def __init__(self):
+        self.parse_args()
+
+        vsphere = self.getVsphereConfig()
+        ignitionData = {}
+        for role in self.roleList:
+            try:
+                with open(self.installDir + '/' + role + '.ign', 'rb') as ignFile:
+                    ignitionData[role] = base64.b64encode(ignFile.read()).decode('ascii')
+            except OSError as e:
+                print("Can not open ignition file: %s" % str(e))
+                sys.exit(1)
+
+        from pyVim.connect import SmartConnectNoSSL, Disconnect
+
+        try:
+            si = SmartConnectNoSSL(host=vsphere['vCenter'], user=vsphere['username'], pwd=vsphere['password'], port=443)
+        except Exception as e:
+            print("Can not connect to vCenter %s: %s" % (vsphere['vCenter'], str(e)))
+            sys.exit(1)
+
+        start = time.time()
+        try:
+            results = self.buildTemplates(si.RetrieveContent(), vsphere, ignitionData)
+        finally:
+            Disconnect(si)
+
+        failed = [result for result in results if result['state'] != 'success']
+        print("Templates done in %.1f s, %d tasks, %d failed." % (time.time() - start, len(results), len(failed)))
+        if failed or len(results) < len(self.roleList):
+            sys.exit(1)
+
+    def getVsphereConfig(self):
+        import yaml
+
+        try:
+            with open(self.yamlFile, 'r') as cfgYamlFile:
+                cfgYaml = yaml.safe_load(cfgYamlFile)
+            vsphere = dict(cfgYaml['platform']['vsphere'])
+        except (OSError, KeyError, TypeError) as e:
+            print("Can not read vSphere settings from %s: %s" % (self.yamlFile, str(e)))
+            sys.exit(1)
+
+        if not self.folderName:
+            self.folderName = cfgYaml['metadata']['name']
+        return vsphere
+
+    def findObject(self, collector, root, objType, name, pathSet = []):
+        for obj, props in collector.collect(root, objType, ['name'] + pathSet):
+            if props.get('name') == name:
+                return obj, props
+        return None, None
+
+    def buildTemplates(self, content, vsphere, ignitionData):
+        from pyVmomi import vim
+
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        from tfConfig import vsphereInventory
+
+        collector = vsphereInventory(content)
+        datacenter, datacenterProps = self.findObject(collector, content.rootFolder, vim.Datacenter, vsphere['datacenter'], ['vmFolder'])
+        if not datacenter:
+            print("Datacenter %s not found." % vsphere['datacenter'])
+            sys.exit(1)
+        cluster, clusterProps = self.findObject(collector, datacenter, vim.ClusterComputeResource, vsphere['cluster'], ['resourcePool'])
+        datastore, datastoreProps = self.findObject(collector, datacenter, vim.Datastore, vsphere['defaultDatastore'])
+        source, sourceProps = self.findObject(collector, datacenter, vim.VirtualMachine, self.sourceName)
+        if not cluster or not datastore or not source:
+            print("Can not find cluster %s, datastore %s or template %s." % (vsphere['cluster'], vsphere['defaultDatastore'], self.sourceName))
+            sys.exit(1)
+
+        # CreateFolder returns at once, it is not a task
+        vmFolder = datacenterProps['vmFolder']
+        folder = None
+        for obj, props in collector.collect(vmFolder, vim.Folder, ['name', 'parent']):
+            if props.get('name') == self.folderName and props['parent']._moId == vmFolder._moId:
+                folder = obj
+        if not folder:
+            folder = vmFolder.CreateFolder(self.folderName)
+
+        existing = {}
+        for obj, props in collector.collect(folder, vim.VirtualMachine, ['name']):
+            existing[props['name']] = obj
+
+        waiter = taskWaiter(content, self.timeout)
+
+        # The extraConfig settings and the template flag are part of the clone
+        # spec, so each template is a single task
+        def startClone(role):
+            name = self.prefix + '-' + role
+            configSpec = vim.vm.ConfigSpec()
+            configSpec.extraConfig = [vim.option.OptionValue(key='guestinfo.ignition.config.data', value=ignitionData[role]),
+                                      vim.option.OptionValue(key='guestinfo.ignition.config.data.encoding', value='base64'),
+                                      vim.option.OptionValue(key='disk.EnableUUID', value='TRUE')]
+            cloneSpec = vim.vm.CloneSpec()
+            cloneSpec.location = vim.vm.RelocateSpec(pool=clusterProps['resourcePool'], datastore=datastore)
+            cloneSpec.config = configSpec
+            cloneSpec.powerOn = False
+            cloneSpec.template = True
+            waiter.add('clone ' + name, source.CloneVM_Task(folder=folder, name=name, spec=cloneSpec))
+
+        for role in self.roleList:
+            name = self.prefix + '-' + role
+            if name in existing:
+                waiter.add('remove ' + name, existing[name].Destroy_Task(), lambda role=role: startClone(role))
+            else:
+                startClone(role)
+
+        return waiter.wait()
+
+    def parse_args(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--yaml', action='store', default=os.environ.get('HOME', '/var/tmp') + '/install-config-template.yaml')
+        parser.add_argument('--install', action='store', default=os.environ.get('HOME', '/var/tmp') + '/oslab')
+        parser.add_argument('--source', action='store', default='rhcos-template')
+        parser.add_argument('--folder', action='store')
+        parser.add_argument('--prefix', action='store', default='rhcos')
+        parser.add_argument('--timeout', action='store', type=int, default=1800)
+        self.args = parser.parse_args()
+        self.yamlFile = self.args.yaml
+        self.installDir = self.args.install
+        self.sourceName = self.args.source
+        self.folderName = self.args.folder
+        self.prefix = self.args.prefix
+        self.timeout = self.args.timeout
+        self.roleList = ['bootstrap', 'master', 'worker']
+
+def main():
+    templateBuilder()
+
+if __name__ == '__main__':
+
+    try:
+        main()
+    except SystemExit as e:
+        if e.code == 0:
+            os._exit(0)
+        else:
+            os._exit(e.code)
@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+
+'''
+Measure tfConfig.py Performance
+'''
+
+import os
+import sys
+import argparse
+import subprocess
+import time
+import statistics
+import json
+import base64
+import tempfile
+import shutil
+
+BENCH_DOMAIN = 'bench.example.com'
+
+BENCH_CONFIG = """apiVersion: v1
+baseDomain: example.com
+compute:
+- name: worker
+  replicas: {workers}
+controlPlane:
+  name: master
+  replicas: 3
+metadata:
+  name: bench
+networking:
+  machineNetwork:
+  - cidr: 10.0.0.0/16
+platform:
+  vsphere:
+    vCenter: vcenter.example.com
+    username: administrator@vsphere.local
+    password: password
+    datacenter: DC1
+    cluster: Cluster1
+    defaultDatastore: datastore1
+    network: VM Network
+    apiVIP: 10.0.0.5
+    ingressVIP: 10.0.0.6
+"""
+
+class benchCase(object):
+    '''
+    Run one tfConfig.py generation path in this process in offline mode with
+    the zone file, saved inventory and answers written by the parent.
+    '''
+
+    def __init__(self, scriptDir, caseDir, path, dualNic, jobs, ignUrl = None, compress = False, force = True):
+        import resource
+
+        sys.path.insert(0, scriptDir)
+        import tfConfig
+
+        sys.argv = ['tfConfig.py', '--trace', caseDir + '/trace.jsonl', '--cache-dir', caseDir + '/cache', '--offline',
+                    '--zone-file', caseDir + '/zone.db', '--inventory', caseDir + '/inventory.json', '--answers', caseDir + '/answers.json']
+        if path == 'nsx':
+            sys.argv.extend(['--nsx', caseDir + '/install-config.yaml', '--dir', caseDir + '/nsxt'])
+        else:
+            sys.argv.extend(['--file', caseDir + '/install-config.yaml', '--dir', caseDir + '/terraform',
+                             '--install', caseDir + '/install', '--id', 'bench-x1y2z', '--template', caseDir + '/rhcos.ova',
+                             '--jobs', str(jobs)])
+            if force:
+                sys.argv.append('--force')
+            if dualNic:
+                sys.argv.append('--dual')
+            if ignUrl:
+                sys.argv.extend(['--ign-url', ignUrl])
+            if compress:
+                sys.argv.append('--compress')
+
+        # Progress goes to stderr so stdout only carries the result
+        stdout = sys.stdout
+        sys.stdout = sys.stderr
+        start = time.perf_counter()
+        tfConfig.osConfig()
+        wallTime = time.perf_counter() - start
+        sys.stdout = stdout
+
+        peakSelf = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peakChildren = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        print(json.dumps({'wall': wallTime, 'peak_kb': max(peakSelf, peakChildren)}))
+
+class tfBench(object):
+
+    def __init__(self):
+        self.scriptDir = os.path.dirname(os.path.abspath(__file__))
+        self.tfConfig = self.scriptDir + '/tfConfig.py'
+        self.parse_args()
+
+        if self.scaleCase:
+            benchCase(self.scriptDir, self.scaleCase, self.casePath, self.caseDual, self.renderJobs, self.ignUrl, self.ignCompress,
+                      not self.incremental)
+            return
+
+        if self.startupTest:
+            if not self.yamlFile:
+                print("Startup test requires an install config YAML file.")
+                sys.exit(1)
+            self.measureStartup()
+
+        if self.scaleTest:
+            self.measureScaling()
+
+        if self.rerunTest:
+            self.checkRerun()
+
+    def timeCommand(self, command):
+        samples = []
+
+        for i in range(self.runCount):
+            start = time.perf_counter()
+            result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            samples.append(time.perf_counter() - start)
+            if result.returncode != 0:
+                print("Command failed: %s" % ' '.join(command))
+                sys.exit(1)
+
+        return samples
+
+    def printSamples(self, label, samples):
+        print("%-32s min %8.2f ms  median %8.2f ms  max %8.2f ms" % (label,
+              min(samples) * 1000,
+              statistics.median(samples) * 1000,
+              max(samples) * 1000))
+
+    def measureStartup(self):
+        queryKeys = ['platform.vsphere.cluster',
+                     'platform.vsphere.datacenter',
+                     'platform.vsphere.defaultDatastore',
+                     'platform.vsphere.username',
+                     'platform.vsphere.password',
+                     'platform.vsphere.vCenter',
+                     'platform.vsphere.network']
+
+        print("Startup time over %d runs:" % self.runCount)
+
+        samples = self.timeCommand([sys.executable, '-c', 'pass'])
+        self.printSamples("interpreter", samples)
+
+        samples = self.timeCommand([sys.executable, self.tfConfig, '--yaml', self.yamlFile, '--get', queryKeys[0]])
+        self.printSamples("single key query", samples)
+
+        samples = self.timeCommand([sys.executable, self.tfConfig, '--yaml', self.yamlFile, '--format', 'shell', '--get'] + queryKeys)
+        self.printSamples("batched query (%d keys)" % len(queryKeys), samples)
+
+        for module in ['yaml', 'jinja2', 'dns.resolver', 'pyVmomi']:
+            samples = self.timeCommand([sys.executable, '-c', 'import ' + module])
+            self.printSamples("import %s" % module, samples)
+
+    def writeZone(self, zoneFile, workerCount, dualNic):
+        hostList = ['bootstrap'] + ['master%d' % i for i in range(3)] + ['worker%d' % i for i in range(workerCount)]
+        lines = []
+        lines.append('$ORIGIN %s.' % BENCH_DOMAIN)
+        lines.append('$TTL 3600')
+        lines.append('@ IN SOA ns1.%s. hostmaster.%s. 1 3600 600 86400 3600' % (BENCH_DOMAIN, BENCH_DOMAIN))
+        lines.append('@ IN NS ns1')
+        lines.append('ns1 IN A 10.0.0.2')
+        lines.append('api IN A 10.0.0.5')
+        lines.append('api-int IN A 10.0.0.5')
+        lines.append('*.apps IN A 10.0.0.6')
+        for i, hostname in enumerate(hostList):
+            offset = i + 10
+            lines.append('%s IN A 10.0.%d.%d' % (hostname, offset // 250, offset % 250 + 1))
+            if dualNic:
+                lines.append('%s-lb IN A 10.1.%d.%d' % (hostname, offset // 250, offset % 250 + 1))
+        with open(zoneFile, 'w') as zoneText:
+            zoneText.write("\n".join(lines) + "\n")
+
+    def writeBaseIgn(self, installDir):
+        # Sizes follow openshift-install output, a large bootstrap config and small pointer configs
+        payload = os.urandom(3 * 1024)
+        bootstrapFiles = []
+        for i in range(100):
+            fileBlock = {}
+            fileBlock['path'] = '/opt/openshift/manifests/bench-%03d.yaml' % i
+            fileBlock['mode'] = 420
+            fileBlock['contents'] = {'source': 'data:text/plain;charset=utf-8;base64,' + base64.b64encode(payload).decode('ascii')}
+            bootstrapFiles.append(fileBlock)
+
+        ignList = {}
+        ignList['bootstrap'] = {'ignition': {'version': '3.1.0'}, 'storage': {'files': bootstrapFiles}}
+        for role in ['master', 'worker']:
+            caBundle = 'data:text/plain;charset=utf-8;base64,' + base64.b64encode(payload[:1200]).decode('ascii')
+            ignList[role] = {'ignition': {'version': '3.1.0',
+                                          'config': {'merge': [{'source': 'https://api-int.%s:22623/config/%s' % (BENCH_DOMAIN, role)}]},
+                                          'security': {'tls': {'certificateAuthorities': [{'source': caBundle}]}}}}
+
+        for role in ignList:
+            with open(installDir + '/' + role + '.ign', 'w') as ignFile:
+                json.dump(ignList[role], ignFile)
+
+    def snapshotFiles(self, baseDir):
+        fileList = {}
+        for dirPath, dirNames, fileNames in os.walk(baseDir):
+            for fileName in fileNames:
+                fileStat = os.stat(dirPath + '/' + fileName)
+                fileList[dirPath + '/' + fileName] = (fileStat.st_size, fileStat.st_mtime_ns)
+        return fileList
+
+    def prepareCase(self, caseDir, workerCount, dualNic):
+        for subDir in ['install', 'terraform', 'nsxt']:
+            os.mkdir(caseDir + '/' + subDir)
+        with open(caseDir + '/install-config.yaml', 'w') as configFile:
+            configFile.write(BENCH_CONFIG.format(workers=workerCount))
+        self.writeZone(caseDir + '/zone.db', workerCount, dualNic)
+        self.writeBaseIgn(caseDir + '/install')
+
+        inventory = {'vcenter': 'vcenter.example.com', 'datacenter': 'DC1', 'dvs': ['dvs-bench'], 'portgroups': ['pg-bench', 'pg-bench-lb']}
+        inventory['capacity'] = {'cluster': 'Cluster1',
+                                 'hosts': [{'name': 'esx%02d' % n, 'cores': 32, 'memory': 524288, 'memory_used': 0} for n in range(8)],
+                                 'datastores': [{'name': 'ds%d' % n, 'type': 'VMFS', 'ssd': n < 2, 'capacity': 2 ** 44, 'free': 2 ** 43} for n in range(4)]}
+        answers = {'switch': 'dvs-bench', 'portgroup': 'pg-bench-lb', 'nic2_prefix': 16, 'router': '',
+                   'nsxt_user': 'admin', 'nsxt_password': 'password', 'nsxt_manager': 'nsx.example.com', 'edge_cluster': 'edge-cluster',
+                   'segment_name': 'segment', 'segment_address': '10.0.0.1/24', 'segment_router': '10.0.0.1'}
+        for fileName, fileData in [('inventory.json', inventory), ('answers.json', answers)]:
+            with open(caseDir + '/' + fileName, 'w') as jsonFile:
+                json.dump(fileData, jsonFile)
+
+    def runChild(self, caseDir, path, workerCount, dualNic, options = []):
+        command = [sys.executable, self.scriptDir + '/tfBench.py', '--scale-case', caseDir, '--path', path, '--jobs', str(self.renderJobs)]
+        if dualNic:
+            command.append('--dual')
+        result = subprocess.run(command + options, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                universal_newlines=True)
+        if result.returncode != 0:
+            print("Benchmark case %s with %d workers failed:" % (path, workerCount))
+            print(result.stderr)
+            sys.exit(1)
+        return json.loads(result.stdout.strip().splitlines()[-1])
+
+    def runCase(self, path, workerCount, dualNic):
+        caseDir = tempfile.mkdtemp(prefix='tfbench-')
+        try:
+            self.prepareCase(caseDir, workerCount, dualNic)
+
+            before = self.snapshotFiles(caseDir)
+            sample = self.runChild(caseDir, path, workerCount, dualNic)
+            after = self.snapshotFiles(caseDir)
+
+            written = [fileName for fileName in after if not fileName.endswith('/trace.jsonl') and before.get(fileName) != after[fileName]]
+            sample['files'] = len(written)
+            sample['bytes'] = sum([after[fileName][0] for fileName in written])
+            sample['phases'] = {}
+            with open(caseDir + '/trace.jsonl', 'r') as traceFile:
+                for line in traceFile:
+                    span = json.loads(line)
+                    sample['phases'][span['phase']] = sample['phases'].get(span['phase'], 0) + span['duration']
+            return sample
+        finally:
+            shutil.rmtree(caseDir, ignore_errors=True)
+
+    def measureScaling(self):
+        print("Generation scaling over %d runs (median), 3 masters:" % self.runCount)
+        print("%-10s %-5s %7s %9s %8s %9s %8s %6s %10s" % ('path', 'nics', 'workers', 'wall ms', 'ms/node',
+                                                         'render ms', 'peak MB', 'files', 'bytes'))
+
+        for path in ['terraform', 'nsx']:
+            for dualNic in [False, True]:
+                if path == 'nsx' and dualNic:
+                    continue
+                for workerCount in self.nodeCounts:
+                    samples = [self.runCase(path, workerCount, dualNic) for i in range(self.runCount)]
+                    wallTime = statistics.median([sample['wall'] for sample in samples])
+                    renderTime = statistics.median([sample['phases'].get('ignition_render', 0) for sample in samples])
+                    peakMemory = max([sample['peak_kb'] for sample in samples]) / 1024.0
+                    nodeCount = workerCount + 4
+                    print("%-10s %-5s %7d %9.1f %8.3f %9.1f %8.1f %6d %10d" % (path, '2' if dualNic else '1', workerCount,
+                          wallTime * 1000, wallTime * 1000 / nodeCount, renderTime * 1000, peakMemory,
+                          samples[-1]['files'], samples[-1]['bytes']))
+
+    def checkBootstrap(self, caseDir, ignUrl):
+        if ignUrl:
+            ignFile = caseDir + '/install/ignition/bootstrap.ign'
+        else:
+            ignFile = caseDir + '/install/bootstrap.ign'
+        with open(ignFile, 'r') as jsonFile:
+            ignData = json.load(jsonFile)
+
+        problems = []
+        pathList = [fileBlock['path'] for fileBlock in ignData.get('storage', {}).get('files', [])]
+        baseCount = len([path for path in pathList if path.startswith('/opt/openshift/manifests/')])
+        if baseCount != 100:
+            problems.append("%d of 100 base files" % baseCount)
+        if pathList.count('/etc/sysconfig/network-scripts/ifcfg-ens192') != 1:
+            problems.append("%d ens192 files" % pathList.count('/etc/sysconfig/network-scripts/ifcfg-ens192'))
+        if ignData.get('ignition', {}).get('config'):
+            problems.append("remote config in the rendered config")
+        return problems
+
+    def checkRerun(self):
+        # A second run with the same input must not write any ignition file, and the
+        # bootstrap config must still carry the full base, also when it is served by URL
+        failed = False
+        for label, ignUrl, compress in [('plain', None, False), ('pointer', 'http://10.0.0.2:8080/', False),
+                                        ('compressed', None, True), ('compressed pointer', 'http://10.0.0.2:8080/', True)]:
+            options = ['--incremental']
+            if ignUrl:
+                options.extend(['--ign-url', ignUrl])
+            if compress:
+                options.append('--compress')
+
+            caseDir = tempfile.mkdtemp(prefix='tfbench-')
+            try:
+                self.prepareCase(caseDir, 5, False)
+                self.runChild(caseDir, 'terraform', 5, False, options)
+                problems = ["first run: " + problem for problem in self.checkBootstrap(caseDir, ignUrl)]
+                before = self.snapshotFiles(caseDir + '/install')
+                self.runChild(caseDir, 'terraform', 5, False, options)
+                after = self.snapshotFiles(caseDir + '/install')
+                problems.extend(["second run: " + problem for problem in self.checkBootstrap(caseDir, ignUrl)])
+                rewritten = [os.path.basename(fileName) for fileName in after
+                             if fileName.endswith('.ign') and before.get(fileName) != after[fileName]]
+                if rewritten:
+                    problems.append("second run wrote %s" % ' '.join(sorted(rewritten)))
+            finally:
+                shutil.rmtree(caseDir, ignore_errors=True)
+
+            print("Rerun %-20s %s" % (label, '; '.join(problems) if problems else 'ok'))
+            failed = failed or bool(problems)
+
+        if failed:
+            sys.exit(1)
+
+    def parse_args(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--startup', action='store_true')
+        parser.add_argument('--yaml', action='store')
+        parser.add_argument('--runs', action='store', type=int)
+        parser.add_argument('--scale', action='store_true')
+        parser.add_argument('--nodes', action='store', default='10,50,100,250,500,1000')
+        parser.add_argument('--jobs', action='store', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--scale-case', action='store')
+        parser.add_argument('--path', action='store', choices=['terraform', 'nsx'], default='terraform')
+        parser.add_argument('--dual', action='store_true')
+        parser.add_argument('--rerun', action='store_true')
+        parser.add_argument('--ign-url', action='store')
+        parser.add_argument('--compress', action='store_true')
+        parser.add_argument('--incremental', action='store_true')
+        self.args = parser.parse_args()
+        self.startupTest = self.args.startup
+        self.yamlFile = self.args.yaml
+        self.scaleTest = self.args.scale
+        self.nodeCounts = [int(count) for count in self.args.nodes.split(',')]
+        self.renderJobs = self.args.jobs
+        self.scaleCase = self.args.scale_case
+        self.casePath = self.args.path
+        self.caseDual = self.args.dual
+        self.rerunTest = self.args.rerun
+        self.ignUrl = self.args.ign_url
+        self.ignCompress = self.args.compress
+        self.incremental = self.args.incremental
+        if self.args.runs:
+            self.runCount = self.args.runs
+        else:
+            self.runCount = 3 if self.scaleTest else 10
+
+def main():
+    tfBench()
+
+if __name__ == '__main__':
+
+    try:
+        main()
+    except SystemExit as e:
+        if e.code == 0:
+            os._exit(0)
+        else:
+            os._exit(e.code)
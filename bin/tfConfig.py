@@ -8,52 +8,20 @@ import os
 import sys
 import argparse
 import json
-import yaml
-import dns.resolver
 import re
-import dns.reversename
 import getpass
 import ipaddress
-from pyVim.connect import SmartConnectNoSSL, Disconnect
-from pyVmomi import vim, vmodl, VmomiSupport
-from jinja2 import Template
+import shlex
 import base64
-
-class osConfig(object):
-
-    def __init__(self):
-        self.configuration = {}
-        self.parse_args()
-
-        if not self.outputDir and not self.yamlFile:
-            print("Terraform directory is required.")
-            sys.exit(1)
-
-        if not self.templateFile:
-            homeDir = os.environ['HOME']
-            self.templateFile = homeDir + "/.rhcos/rhcos-vmware.x86_64.ova"
-
-        if self.yamlFile and self.getValue:
-            print(self.getYamlValue())
-        elif self.getValue:
-            self.getVarValue()
-        elif self.cfgFile:
-            if self.installDir and self.infraId:
-                self.generateConfigs()
-            else:
-                print("Install directory and infrastructure ID are required.")
-                sys.exit(1)
-        elif self.nsxCfgFile:
-            self.generateNsxConfig()
-        elif self.setKey:
-            if self.setValue:
-                self.updateConfig()
-
-    def updateIgn(self, hostname, role, prefix = [], address = [], domain = None, route = None, dns = []):
-        ignFile = self.installDir + '/' + role + '.ign'
-        outFile = self.installDir + '/' + hostname + '.ign'
-        storageBlock = []
-        ifcfg_a = """TYPE=Ethernet
+import hashlib
+import gzip
+import urllib.parse
+import time
+import contextlib
+import tempfile
+import concurrent.futures
+
+IFCFG_A = """TYPE=Ethernet
 BOOTPROTO=none
 NAME=ens192
 DEVICE=ens192
@@ -69,7 +37,8 @@ DNS{{ loop.index }}={{ item }}{{ "
 " if not loop.last }}
 {%- endfor %}
 """
-        ifcfg_b = """TYPE=Ethernet
+
+IFCFG_B = """TYPE=Ethernet
 BOOTPROTO=none
 NAME=ens224
 DEVICE=ens224
@@ -81,72 +50,629 @@ GATEWAY={{ gateway }}
 {%- endif %}
 """
 
-        t = Template(ifcfg_a)
-        ifcfgBlock = t.render(ip_address=address[0], ip_prefix=prefix[0], gateway=route, domain_name=domain, dns_list=dns, nics=len(address))
-        block_bytes = ifcfgBlock.encode('ascii')
+NODE_PATTERN = re.compile(r'^(bootstrap|master|worker)([0-9]*)(-lb)?$')
+
+class ignRenderer(object):
+    '''
+    Render per-host ignition files from the role base ignition files. Each base
+    file is parsed once and each NIC template is compiled once per process.
+    '''
+
+    def __init__(self, installDir, pointerUrl = None, compress = False):
+        self.installDir = installDir
+        self.pointerUrl = pointerUrl
+        self.compress = compress
+        self.serveDir = installDir + '/ignition'
+        self.baseDir = installDir + '/.ignition-base'
+        self.baseIgn = {}
+        self.baseDigest = {}
+        self.baseContent = {}
+        self.compressedIgn = {}
+        self.templates = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['templates'] = None
+        return state
+
+    def getTemplates(self):
+        from jinja2 import Template
+
+        if not self.templates:
+            self.templates = (Template(IFCFG_A), Template(IFCFG_B))
+        return self.templates
+
+    def getBaseIgn(self, role):
+        if role not in self.baseIgn:
+            ignFile = self.installDir + '/' + role + '.ign'
+            savedFile = self.baseDir + '/' + role + '.ign'
+            with open(ignFile, 'rb') as jsonFile:
+                ignBytes = jsonFile.read()
+            ignDigest = hashlib.sha256(ignBytes).hexdigest()
+
+            # A host named after its role (bootstrap) writes over the base file. When the
+            # file is still that output, render from the copy saved before the first run,
+            # otherwise it is a new base from openshift-install and the copy is replaced.
+            try:
+                with open(savedFile + '.rendered', 'r') as digestFile:
+                    renderedDigest = digestFile.read().strip()
+            except OSError:
+                renderedDigest = None
+            try:
+                with open(savedFile, 'rb') as jsonFile:
+                    savedBytes = jsonFile.read()
+            except OSError:
+                savedBytes = None
+            if savedBytes is not None and renderedDigest == ignDigest:
+                ignBytes = savedBytes
+            elif savedBytes != ignBytes:
+                os.makedirs(self.baseDir, exist_ok=True)
+                with open(savedFile + '.tmp', 'wb') as jsonFile:
+                    jsonFile.write(ignBytes)
+                os.replace(savedFile + '.tmp', savedFile)
+
+            self.baseDigest[role] = hashlib.sha256(ignBytes).hexdigest()
+            self.baseIgn[role] = json.loads(ignBytes)
+        return self.baseIgn[role]
+
+    def inputHash(self, job):
+        # The base digest is of the saved copy, which no render writes over
+        self.getBaseIgn(job[1])
+        inputList = [list(job), self.baseDigest[job[1]], self.pointerUrl, self.compress]
+        return hashlib.sha256(json.dumps(inputList).encode('utf-8')).hexdigest()
+
+    def getCompressedIgn(self, role):
+        if role not in self.compressedIgn:
+            ignData = dict(self.getBaseIgn(role))
+            ignData['storage'] = dict(ignData.get('storage', {}))
+            ignData['storage']['files'] = [self.compressFile(f) for f in ignData['storage'].get('files', [])]
+            self.compressedIgn[role] = ignData
+            self.baseContent[role] = dict([(f.get('path'), self.contentSize(f)) for f in ignData['storage']['files']])
+        return self.compressedIgn[role]
+
+    def compressFile(self, fileBlock):
+        contents = fileBlock.get('contents', {})
+        source = contents.get('source')
+
+        if not source or not source.startswith('data:') or contents.get('compression'):
+            return fileBlock
+
+        header, data = source[5:].split(',', 1)
+        if header.endswith(';base64'):
+            fileBytes = base64.b64decode(data)
+        else:
+            fileBytes = urllib.parse.unquote_to_bytes(data)
+
+        # Fixed mtime so identical input always produces identical output
+        gzipBytes = gzip.compress(fileBytes, compresslevel=9, mtime=0)
+        compressedSource = 'data:;base64,' + base64.b64encode(gzipBytes).decode('ascii')
+        if len(compressedSource) >= len(source):
+            return fileBlock
+
+        newBlock = dict(fileBlock)
+        newBlock['contents'] = dict(contents)
+        newBlock['contents']['source'] = compressedSource
+        newBlock['contents']['compression'] = 'gzip'
+        return newBlock
+
+    def contentSize(self, fileBlock):
+        # Decoded bytes of an inline file before and after gzip, zero for remote sources
+        contents = fileBlock.get('contents', {})
+        source = contents.get('source')
+
+        if not source or not source.startswith('data:'):
+            return 0, 0
+
+        header, data = source[5:].split(',', 1)
+        if header.endswith(';base64'):
+            fileBytes = base64.b64decode(data)
+        else:
+            fileBytes = urllib.parse.unquote_to_bytes(data)
+
+        if contents.get('compression') == 'gzip':
+            return len(gzip.decompress(fileBytes)), len(fileBytes)
+        return len(fileBytes), len(fileBytes)
+
+    def nicFile(self, device, contents):
+        block_bytes = contents.encode('ascii')
         base64_bytes = base64.b64encode(block_bytes)
 
-        firstNic = {}
-        firstNic['filesystem'] = 'root'
-        firstNic['path'] = '/etc/sysconfig/network-scripts/ifcfg-ens192'
-        firstNic['mode'] = 420
-        firstNic['contents'] = {}
-        firstNic['contents']['source'] = 'data:text/plain;charset=utf-8;base64,' + base64_bytes.decode('ascii')
-        storageBlock.append(firstNic)
+        nicBlock = {}
+        nicBlock['filesystem'] = 'root'
+        nicBlock['path'] = '/etc/sysconfig/network-scripts/ifcfg-' + device
+        nicBlock['mode'] = 420
+        nicBlock['contents'] = {}
+        nicBlock['contents']['source'] = 'data:text/plain;charset=utf-8;base64,' + base64_bytes.decode('ascii')
+        return nicBlock
+
+    def render(self, hostname, role, prefix, address, domain, route, dns, compress = False):
+        template_a, template_b = self.getTemplates()
+        storageBlock = []
+
+        ifcfgBlock = template_a.render(ip_address=address[0], ip_prefix=prefix[0], gateway=route, domain_name=domain, dns_list=dns, nics=len(address))
+        storageBlock.append(self.nicFile('ens192', ifcfgBlock))
 
         if len(address) > 1:
-            t = Template(ifcfg_b)
-            ifcfgBlock = t.render(ip_address=address[1], ip_prefix=prefix[1], gateway=route, nics=len(address))
-            block_bytes = ifcfgBlock.encode('ascii')
-            base64_bytes = base64.b64encode(block_bytes)
-
-            secondNic = {}
-            secondNic['filesystem'] = 'root'
-            secondNic['path'] = '/etc/sysconfig/network-scripts/ifcfg-ens224'
-            secondNic['mode'] = 420
-            secondNic['contents'] = {}
-            secondNic['contents']['source'] = 'data:text/plain;charset=utf-8;base64,' + base64_bytes.decode('ascii')
-            storageBlock.append(secondNic)
-
-        try:
-            with open(ignFile, 'r') as jsonFile:
-                ignData = json.load(jsonFile)
-            jsonFile.close()
+            ifcfgBlock = template_b.render(ip_address=address[1], ip_prefix=prefix[1], gateway=route, nics=len(address))
+            storageBlock.append(self.nicFile('ens224', ifcfgBlock))
+
+        if compress:
+            storageBlock = [self.compressFile(f) for f in storageBlock]
+            ignData = dict(self.getCompressedIgn(role))
+        else:
+            ignData = dict(self.getBaseIgn(role))
+
+        # Shallow copy down to the file list so the cached base is never modified. NIC files
+        # already in the base are replaced by the ones rendered for this host.
+        nicPaths = [nicBlock['path'] for nicBlock in storageBlock]
+        ignData['storage'] = dict(ignData.get('storage', {}))
+        ignData['storage']['files'] = [f for f in ignData['storage'].get('files', []) if f.get('path') not in nicPaths] + storageBlock
+        return ignData
+
+    def pointerIgn(self, hostname, ignData, digest):
+        version = ignData.get('ignition', {}).get('version', '3.1.0')
+        # Spec 2.x configs append remote configs, spec 3.x configs merge them
+        mergeKey = 'append' if version.startswith('2.') else 'merge'
+
+        configBlock = {}
+        configBlock['source'] = self.pointerUrl.rstrip('/') + '/' + hostname + '.ign'
+        configBlock['verification'] = {}
+        configBlock['verification']['hash'] = 'sha512-' + digest
+
+        pointerData = {}
+        pointerData['ignition'] = {}
+        pointerData['ignition']['version'] = version
+        pointerData['ignition']['config'] = {}
+        pointerData['ignition']['config'][mergeKey] = [configBlock]
+        return pointerData
+
+    def serialize(self, ignData):
+        if self.compress:
+            return json.dumps(ignData, separators=(',', ':')) + "\n"
+        return json.dumps(ignData, indent=2) + "\n"
+
+    def write(self, hostname, ignData):
+        outFile = self.installDir + '/' + hostname + '.ign'
+        ignText = self.serialize(ignData)
+        outSize = len(ignText)
+        outputs = [outFile]
+        digest = None
+
+        if self.pointerUrl:
+            ignBytes = ignText.encode('utf-8')
+            digest = hashlib.sha512(ignBytes).hexdigest()
+            serveFile = self.serveDir + '/' + hostname + '.ign'
+            with open(serveFile, 'wb') as jsonFile:
+                jsonFile.write(ignBytes)
+            outputs.append(serveFile)
+            ignText = self.serialize(self.pointerIgn(hostname, ignData, digest))
+
+        with open(outFile, 'w') as jsonFile:
+            jsonFile.write(ignText)
+
+        # Record what was written over a role base file so the next run renders from the saved copy
+        if os.path.exists(self.baseDir + '/' + hostname + '.ign'):
+            with open(self.baseDir + '/' + hostname + '.ign.rendered', 'w') as digestFile:
+                digestFile.write(hashlib.sha256(ignText.encode('utf-8')).hexdigest() + "\n")
+
+        return digest, outSize, outputs
+
+    def hostContentSize(self, role, ignData):
+        # Base files are measured once per role, the NIC files rendered for this host here
+        rawSize, gzipSize = 0, 0
+        for fileBlock in ignData['storage']['files']:
+            if fileBlock.get('path', '').startswith('/etc/sysconfig/network-scripts/ifcfg-'):
+                fileSize = self.contentSize(fileBlock)
+            else:
+                fileSize = self.baseContent[role].get(fileBlock.get('path'), (0, 0))
+            rawSize += fileSize[0]
+            gzipSize += fileSize[1]
+        return rawSize, gzipSize
+
+    def renderHost(self, job):
+        result = {}
+        result['hostname'] = job[0]
+        result['input'] = self.inputHash(job)
+        ignData = self.render(*job, compress=self.compress)
+        result['digest'], result['outSize'], outputs = self.write(job[0], ignData)
+        if self.compress:
+            result['rawSize'], result['gzipSize'] = self.hostContentSize(job[1], ignData)
+        result['outputs'] = {}
+        for outFile in outputs:
+            fileStat = os.stat(outFile)
+            result['outputs'][outFile] = [fileStat.st_size, fileStat.st_mtime_ns]
+        return result
+
+ignWorker = None
+
+def ignWorkerInit(renderer):
+    global ignWorker
+    ignWorker = renderer
+
+def ignWorkerRender(job):
+    return ignWorker.renderHost(job)
+
+class dnsDiscovery(object):
+    '''
+    Run DNS lookups concurrently with the dnspython async resolver. At most
+    concurrency queries are in flight and each one is limited to timeout seconds.
+    '''
+
+    def __init__(self, concurrency = 16, timeout = 10.0):
+        import dns.asyncresolver
+
+        self.resolver = dns.asyncresolver.Resolver()
+        self.resolver.lifetime = timeout
+        self.concurrency = concurrency
+        self.semaphore = None
+
+    async def resolve(self, name, rdtype):
+        import asyncio
+
+        if not self.semaphore:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        async with self.semaphore:
+            return await self.resolver.resolve(name, rdtype, tcp=True)
+
+    async def resolveAddresses(self, names):
+        import asyncio
+
+        answers = await asyncio.gather(*[self.resolve(name, "A") for name in names])
+        return {name: answer[0].address for name, answer in zip(names, answers)}
+
+    async def primarySerial(self, domain, master_addr):
+        import dns.asyncquery
+        import dns.message
+        import dns.rdatatype
+
+        response = await dns.asyncquery.tcp(dns.message.make_query(domain, 'SOA'), master_addr, timeout=self.resolver.lifetime)
+        for rrset in response.answer:
+            if rrset.rdtype == dns.rdatatype.SOA:
+                return rrset[0].serial
+        raise ValueError("no SOA record for %s from %s" % (domain, master_addr))
+
+    async def zoneServers(self, domain):
+        import asyncio
+
+        soa_answer, ns_answer = await asyncio.gather(self.resolve(domain, "SOA"), self.resolve(domain, "NS"))
+        soa_record = soa_answer[0]
+        nsList = sorted([rdata.target.to_text() for rdata in ns_answer])
+
+        addresses = await self.resolveAddresses(sorted(set(nsList + [soa_record.mname.to_text()])))
+        master_addr = addresses[soa_record.mname.to_text()]
+
+        # A recursive resolver can hand out a cached SOA until its TTL runs out, so the
+        # serial compared with the zone cache is asked of the zone primary itself
+        return await self.primarySerial(domain, master_addr), master_addr, [addresses[name] for name in nsList]
+
+    async def lookupAll(self, queries):
+        import asyncio
+
+        # Failed lookups are returned as exceptions so every query is reported
+        return await asyncio.gather(*[self.resolve(name, rdtype) for name, rdtype in queries], return_exceptions=True)
+
+class vsphereInventory(object):
+    '''
+    Read vSphere inventory with one PropertyCollector request per object type,
+    returning only the requested properties instead of a round trip per attribute.
+    '''
+
+    def __init__(self, content):
+        self.content = content
+
+    def collect(self, root, objType, pathSet):
+        from pyVmomi import vim, vmodl
+
+        container = self.content.viewManager.CreateContainerView(root, [objType], True)
+        try:
+            traversalSpec = vmodl.query.PropertyCollector.TraversalSpec(name='traverseEntities',
+                                                                        path='view',
+                                                                        skip=False,
+                                                                        type=vim.view.ContainerView)
+            objectSpec = vmodl.query.PropertyCollector.ObjectSpec(obj=container, skip=True, selectSet=[traversalSpec])
+            propertySpec = vmodl.query.PropertyCollector.PropertySpec(type=objType, pathSet=pathSet, all=False)
+            filterSpec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[objectSpec], propSet=[propertySpec])
+            result = self.content.propertyCollector.RetrieveContents([filterSpec])
+        finally:
+            container.Destroy()
+
+        return [(item.obj, {prop.name: prop.val for prop in item.propSet}) for item in result]
+
+    def getDatacenter(self, name):
+        from pyVmomi import vim
+
+        for obj, props in self.collect(self.content.rootFolder, vim.Datacenter, ['name', 'networkFolder', 'hostFolder', 'datastoreFolder']):
+            if props.get('name') == name:
+                return props
+        return None
+
+    def getNetworks(self, datacenter):
+        from pyVmomi import vim
+
+        folder = datacenter['networkFolder']
+        dvsList = [props['name'] for obj, props in self.collect(folder, vim.dvs.VmwareDistributedVirtualSwitch, ['name'])]
+        pgList = [props['name'] for obj, props in self.collect(folder, vim.dvs.DistributedVirtualPortgroup, ['name'])]
+        return dvsList, sorted(set(pgList))
+
+    def getCapacity(self, datacenter, clusterName):
+        from pyVmomi import vim
+
+        cluster = None
+        for obj, props in self.collect(datacenter['hostFolder'], vim.ClusterComputeResource, ['name', 'host', 'datastore']):
+            if props.get('name') == clusterName:
+                cluster = props
+        if not cluster:
+            return None
+
+        hostIds = set([host._moId for host in cluster.get('host', [])])
+        datastoreIds = set([datastore._moId for datastore in cluster.get('datastore', [])])
+
+        # Hosts in maintenance mode or disconnected can not run new nodes
+        hostList = []
+        for obj, props in self.collect(datacenter['hostFolder'], vim.HostSystem,
+                                       ['name', 'summary.hardware.numCpuCores', 'summary.hardware.memorySize',
+                                        'summary.quickStats.overallMemoryUsage', 'runtime.inMaintenanceMode',
+                                        'runtime.connectionState']):
+            if obj._moId not in hostIds or props.get('runtime.inMaintenanceMode') or props.get('runtime.connectionState') != 'connected':
+                continue
+            host = {}
+            host['name'] = props['name']
+            host['cores'] = props.get('summary.hardware.numCpuCores', 0)
+            host['memory'] = props.get('summary.hardware.memorySize', 0) // 1048576
+            host['memory_used'] = props.get('summary.quickStats.overallMemoryUsage') or 0
+            hostList.append(host)
+
+        # Only datastores shared by the cluster hosts, local disks would pin a node to one host
+        datastoreList = []
+        for obj, props in self.collect(datacenter['datastoreFolder'], vim.Datastore,
+                                       ['name', 'info', 'summary.capacity', 'summary.freeSpace', 'summary.accessible',
+                                        'summary.multipleHostAccess', 'summary.maintenanceMode', 'summary.type']):
+            if obj._moId not in datastoreIds or not props.get('summary.accessible') or not props.get('summary.multipleHostAccess') \
+                    or props.get('summary.maintenanceMode', 'normal') != 'normal':
+                continue
+            vmfs = getattr(props.get('info'), 'vmfs', None)
+            datastore = {}
+            datastore['name'] = props['name']
+            datastore['type'] = props.get('summary.type')
+            datastore['ssd'] = bool(getattr(vmfs, 'ssd', False)) or props.get('summary.type') == 'vsan'
+            datastore['capacity'] = props.get('summary.capacity', 0)
+            datastore['free'] = props.get('summary.freeSpace', 0)
+            datastoreList.append(datastore)
+
+        capacity = {}
+        capacity['cluster'] = clusterName
+        capacity['hosts'] = sorted(hostList, key=lambda host: host['name'])
+        capacity['datastores'] = sorted(datastoreList, key=lambda datastore: datastore['name'])
+        return capacity
+
+class phaseTracer(object):
+    '''
+    Record the duration of named phases as JSON lines appended to a trace file.
+    prepOpenShift.sh writes its steps to the same file in the same format.
+    '''
+
+    def __init__(self, traceFile = None, source = 'tfConfig.py'):
+        self.traceFile = traceFile
+        self.source = source
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        status = 0
+        try:
+            yield
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+            raise
+        except BaseException:
+            status = 1
+            raise
+        finally:
+            self.record(name, start, time.time(), status)
+
+    def record(self, name, start, end, status = 0):
+        if not self.traceFile:
+            return
+
+        span = {}
+        span['source'] = self.source
+        span['phase'] = name
+        span['start'] = round(start, 6)
+        span['end'] = round(end, 6)
+        span['duration'] = round(end - start, 6)
+        span['status'] = status
+
+        try:
+            with open(self.traceFile, 'a') as traceFile:
+                traceFile.write(json.dumps(span) + "\n")
         except OSError as e:
-            print("Can not open ignition file: %s" % str(e))
+            print("Can not write trace file: %s" % str(e))
+
+class osConfig(object):
+
+    def __init__(self):
+        self.configuration = {}
+        self.parse_args()
+        self.tracer = phaseTracer(self.traceFile)
+        self.answers = self.loadAnswers()
+
+        if self.traceReport:
+            self.writeTraceReport()
+            return
+
+        if self.serveIgn:
+            if not self.installDir or not self.ignUrl:
+                print("Install directory and ignition URL are required.")
+                sys.exit(1)
+            self.serveIgnitions()
+            return
+
+        if not self.outputDir and not self.yamlFile and not self.validateOnly:
+            print("Terraform directory is required.")
             sys.exit(1)
 
-        if 'storage' not in ignData:
-            ignData['storage'] = {}
-            ignData['storage']['files'] = []
-        ignData['storage']['files'].extend(storageBlock)
+        if not self.templateFile:
+            homeDir = os.environ['HOME']
+            self.templateFile = homeDir + "/.rhcos/rhcos-vmware.x86_64.ova"
+
+        if self.yamlFile and self.getValue:
+            self.printQueryResults(self.getYamlValues())
+        elif self.getValue:
+            self.printQueryResults(self.getVarValues())
+        elif self.addWorkers:
+            with self.lockFile(self.outputDir + '/variables.tf.json'):
+                self.addWorkerNodes()
+        elif self.cfgFile and self.validateOnly:
+            self.validateConfig()
+        elif self.cfgFile:
+            if self.installDir and self.infraId:
+                self.generateConfigs()
+            else:
+                print("Install directory and infrastructure ID are required.")
+                sys.exit(1)
+        elif self.nsxCfgFile:
+            self.generateNsxConfig()
+        elif self.setKey or self.updateList or self.batchFile:
+            self.updateConfig()
+
+    def updateIgn(self, hostname, role, prefix = [], address = [], domain = None, route = None, dns = []):
+        self.renderIgnitions([(hostname, role, prefix, address, domain, route, dns)])
+
+    def renderIgnitions(self, ignJobs):
+        renderer = ignRenderer(self.installDir, self.ignUrl, self.ignCompress)
+        manifestFile = self.installDir + '/.ignition-manifest.json'
+        manifest = {}
+        resultList = []
+
+        for role in sorted(set([job[1] for job in ignJobs])):
+            try:
+                renderer.getBaseIgn(role)
+                if self.ignCompress:
+                    renderer.getCompressedIgn(role)
+            except (OSError, ValueError) as e:
+                print("Can not open ignition file: %s" % str(e))
+                sys.exit(1)
+
+        if not self.forceRender and os.path.exists(manifestFile):
+            try:
+                with open(manifestFile, 'r') as jsonFile:
+                    manifest = json.load(jsonFile)
+            except (OSError, ValueError) as e:
+                print("Ignoring unreadable ignition manifest: %s" % str(e))
+
+        jobCount = len(ignJobs)
+        ignJobs = [job for job in ignJobs if not self.ignitionCurrent(manifest.get(job[0]), renderer.inputHash(job))]
 
         try:
-            with open(outFile, 'w') as jsonFile:
-                json.dump(ignData, jsonFile, indent=2)
-                jsonFile.write("\n")
-                jsonFile.close()
+            if self.ignUrl and not os.path.isdir(renderer.serveDir):
+                os.mkdir(renderer.serveDir)
+            if self.renderJobs <= 1 or len(ignJobs) <= self.renderJobs:
+                for job in ignJobs:
+                    resultList.append(renderer.renderHost(job))
+            else:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=self.renderJobs,
+                                                            initializer=ignWorkerInit,
+                                                            initargs=(renderer,)) as executor:
+                    chunkSize = max(1, len(ignJobs) // (self.renderJobs * 4))
+                    resultList.extend(executor.map(ignWorkerRender, ignJobs, chunksize=chunkSize))
+            if self.ignUrl:
+                self.writeDigestList(renderer.serveDir, [(r['hostname'], r['digest']) for r in resultList])
         except OSError as e:
             print("Can not write to new ignition file: %s" % str(e))
             sys.exit(1)
 
+        for result in resultList:
+            manifest[result['hostname']] = {'input': result['input'], 'outputs': result['outputs']}
+
+        try:
+            self.replaceFile(manifestFile, json.dumps(manifest, indent=2, sort_keys=True) + "\n")
+        except OSError as e:
+            print("Can not write ignition manifest: %s" % str(e))
+
+        print("Ignition files: %d written, %d unchanged." % (len(resultList), jobCount - len(resultList)))
+
+        if self.ignCompress and resultList:
+            rawSize = sum([r['rawSize'] for r in resultList])
+            gzipSize = sum([r['gzipSize'] for r in resultList])
+            outSize = sum([r['outSize'] for r in resultList])
+            print("Ignition file contents: %d bytes -> %d bytes gzip (%.1f%% smaller)" %
+                  (rawSize, gzipSize, 100.0 - (gzipSize * 100.0 / max(rawSize, 1))))
+            print("Ignition output: %d files, %d bytes of minified JSON" % (len(resultList), outSize))
+
+    def ignitionCurrent(self, entry, inputHash):
+        if not entry or entry.get('input') != inputHash:
+            return False
+
+        # Outputs edited or removed since the last run are written again
+        for outFile, outStat in entry.get('outputs', {}).items():
+            try:
+                fileStat = os.stat(outFile)
+            except OSError:
+                return False
+            if [fileStat.st_size, fileStat.st_mtime_ns] != outStat:
+                return False
+
+        return True
+
+    def writeDigestList(self, serveDir, digestList):
+        sumFile = serveDir + '/sha512sum.txt'
+        sumList = {}
+
+        if os.path.exists(sumFile):
+            with open(sumFile, 'r') as digestFile:
+                for line in digestFile:
+                    digest, fileName = line.split()
+                    sumList[fileName] = digest
+
+        for hostname, digest in digestList:
+            sumList[hostname + '.ign'] = digest
+
+        with open(sumFile, 'w') as digestFile:
+            for fileName in sorted(sumList):
+                digestFile.write("%s  %s\n" % (sumList[fileName], fileName))
+
+    def serveIgnitions(self):
+        import http.server
+        import functools
+        import urllib.parse
+
+        serveDir = self.installDir + '/ignition'
+        port = urllib.parse.urlparse(self.ignUrl).port or 80
+
+        if not os.path.isdir(serveDir):
+            print("Ignition directory %s not found." % serveDir)
+            sys.exit(1)
+
+        handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=serveDir)
+        try:
+            server = http.server.ThreadingHTTPServer(('', port), handler)
+        except OSError as e:
+            print("Can not start ignition server: %s" % str(e))
+            sys.exit(1)
+
+        print("Serving %s on port %d" % (serveDir, port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+
     def generateConfigs(self):
+        import yaml
+
         variableJson = {}
         variableJson['variable'] = {}
         variableJson['variable'].update({'install_dir': {'default': self.installDir}})
         variableJson['variable'].update({'infra_id': {'default': self.infraId}})
         variableJson['variable'].update({'ova_file': {'default': self.templateFile}})
         variableSaveFile = self.outputDir + '/variables.tf.json'
-        foundMaster = False
-        foundWorker = False
-        foundBootstrap = False
-        masterCount = 0
-        workerCount = 0
         prefix_list = []
+        ignJobs = []
         cfgYaml = None
+        nsxJson = None
 
         try:
-            with open(self.cfgFile, 'r') as cfgYamlFile:
+            with open(self.cfgFile, 'r') as cfgYamlFile, self.tracer.phase('yaml_parse'):
                 cfgYaml = yaml.safe_load(cfgYamlFile)
         except OSError as e:
                 print("Can not open install config file: %s" % str(e))
@@ -174,47 +700,16 @@ GATEWAY={{ gateway }}
             if key == 'metadata':
                 variableJson['variable'].update({'cluster_name': {'default': cfgYaml['metadata']['name']}})
 
-        si = SmartConnectNoSSL(host=variableJson['variable']['vsphere_server']['default'],
-                               user=variableJson['variable']['vsphere_user']['default'],
-                               pwd=variableJson['variable']['vsphere_password']['default'],
-                               port=443)
-
-        content = si.RetrieveContent()
-        datacenter = None
-        container = content.viewManager.CreateContainerView(content.rootFolder, [vim.Datacenter], True)
-        for c in container.view:
-            if c.name == variableJson['variable']['vsphere_datacenter']['default']:
-                datacenter = c
-                break
-        container.Destroy()
-
-        folder = datacenter.networkFolder
-        dvsList = []
-        container = content.viewManager.CreateContainerView(folder, [vim.dvs.VmwareDistributedVirtualSwitch], True)
-        for managed_object_ref in container.view:
-            dvsList.append(managed_object_ref.name)
-        container.Destroy()
-
-        pgList = []
-        container = content.viewManager.CreateContainerView(folder, [vim.dvs.DistributedVirtualPortgroup], True)
-        for managed_object_ref in container.view:
-            pgList.append(managed_object_ref.name)
-        container.Destroy()
-        pgList = sorted(set(pgList))
-
-        while True:
-            for i in range(len(dvsList)):
-                print(" %d) %s" % (i+1,dvsList[i]))
-            switchSelection = input("Virtual Switch [%d-%d]: " % (1, len(dvsList)))
-            try:
-                int(switchSelection)
-            except ValueError:
-                continue
-            if int(switchSelection) < 1 or int(switchSelection) > len(dvsList):
-                continue
-            break
+        with self.tracer.phase('inventory'):
+            inventory = self.getInventory(variableJson['variable']['vsphere_server']['default'],
+                                          variableJson['variable']['vsphere_user']['default'],
+                                          variableJson['variable']['vsphere_password']['default'],
+                                          variableJson['variable']['vsphere_datacenter']['default'],
+                                          variableJson['variable']['vsphere_cluster']['default'])
+        dvsList = inventory['dvs']
+        pgList = inventory['portgroups']
 
-        variableJson['variable'].update({'vsphere_dvs_switch': {'default': dvsList[int(switchSelection)-1]}})
+        variableJson['variable'].update({'vsphere_dvs_switch': {'default': self.selectItem('switch', "Virtual Switch", dvsList)}})
 
         networkMask = cfgYaml['networking']['machineNetwork'][0]['cidr']
         machineNetwork = ipaddress.IPv4Network(networkMask)
@@ -222,33 +717,14 @@ GATEWAY={{ gateway }}
         prefix_list.append(str(machineNetwork.prefixlen))
 
         if self.dualNic:
-            while True:
-                for i in range(len(pgList)):
-                    print(" %d) %s" % (i+1,pgList[i]))
-                pgSelection = input("Virtual Switch [%d-%d]: " % (1, len(pgList)))
-                try:
-                    int(pgSelection)
-                except ValueError:
-                    continue
-                if int(pgSelection) < 1 or int(pgSelection) > len(pgList):
-                    continue
-                break
             variableJson['variable']['vsphere_network']['default']['nic2'] = {}
-            variableJson['variable']['vsphere_network']['default']['nic2'].update({'network': pgList[int(pgSelection)-1]})
-            while True:
-                network_bits = input("Network Prefix Length for second interface: ")
-                try:
-                    int(network_bits)
-                except ValueError:
-                    continue
-                if int(network_bits) < 1 or int(network_bits) > 30:
-                    continue
-                break
-            prefix_list.append(network_bits)
+            variableJson['variable']['vsphere_network']['default']['nic2'].update({'network': self.selectItem('portgroup', "Virtual Switch", pgList)})
+            prefix_list.append(self.getPrefixLength())
 
         variableJson['variable'].update({'ip_broadcast': {'default': str(machineNetwork.broadcast_address)}})
         variableJson['variable'].update({'ip_mask': {'default': str(machineNetwork.netmask)}})
         variableJson['variable'].update({'ip_prefix': {'default': str(machineNetwork.prefixlen)}})
+        variableJson['variable'].update({'ip_prefix_list': {'type': 'list(string)', 'default': prefix_list}})
 
         variableJson['variable'].update({'bootstrap_spec': {}})
         variableJson['variable']['bootstrap_spec']['type'] = 'map'
@@ -264,27 +740,14 @@ GATEWAY={{ gateway }}
 
         domain = variableJson['variable']['cluster_name']['default'] + '.' + variableJson['variable']['domain_name']['default']
         try:
-            soa_answer = dns.resolver.query(domain, "SOA", tcp=True)
-            soa_host = soa_answer[0].mname
-
-            master_answer = dns.resolver.query(soa_host, "A", tcp=True)
-            master_addr = master_answer[0].address
-
-            xfr_answer = dns.query.xfr(master_addr, domain)
-            zone = dns.zone.from_xfr(xfr_answer)
+            with self.tracer.phase('dns'):
+                zone, dnsList = self.getZone(domain)
 
             variableJson['variable'].update({'ip_dns': {}})
             variableJson['variable']['ip_dns']['type'] = 'list(string)'
-            variableJson['variable']['ip_dns']['default'] = []
-            for name, ttl, rdata in zone.iterate_rdatas("NS"):
-                dnsServerIp = dns.resolver.query(rdata.to_text(), "A", tcp=True)
-                dnsServerIp = dnsServerIp[0].address
-                variableJson['variable']['ip_dns']['default'].append(dnsServerIp)
-
-            zone_records = zone.iterate_rdatas("A")
-            zone_list = {}
-            for name, ttl, rdata in zone_records:
-                zone_list.update({name.to_text(): rdata.to_text()})
+            variableJson['variable']['ip_dns']['default'] = dnsList
+
+            zone_list = self.zoneAddresses(zone)
         except Exception as e:
             print("Could not query domain %s: %s" % (domain, str(e)))
             sys.exit(1)
@@ -303,286 +766,1177 @@ GATEWAY={{ gateway }}
                 print("Error: Cluster configuration requires DNS entries: bootstrap not found.")
                 sys.exit(1)
 
-        routeAnswer = input("Default router [%s]: " % defaultRouter)
+        if 'router' in self.answers:
+            routeAnswer = self.answers['router']
+        else:
+            routeAnswer = input("Default router [%s]: " % defaultRouter)
         if routeAnswer:
             defaultRouter = routeAnswer
 
         variableJson['variable'].update({'ip_route': {'default': defaultRouter}})
 
-        if 'bootstrap' in zone_list:
-            foundBootstrap = True
-            address_list = []
-            hostBlock = {'bootstrap': {}}
-            hostBlock['bootstrap']['host_name'] = 'bootstrap'
-            hostBlock['bootstrap']['nic1'] = {}
-            hostBlock['bootstrap']['nic1']['ip_address'] = zone_list['bootstrap']
-            address_list.append(zone_list['bootstrap'])
+        nodeIndex = self.buildNodeIndex(zone_list)
+
+        if not nodeIndex['bootstrap'] or not nodeIndex['master'] or not nodeIndex['worker']:
+            print("Could not find all required nodes for domain %s." % domain)
+            sys.exit(1)
+
+        if not self.skipValidate:
+            with self.tracer.phase('validate'):
+                if not self.validateCluster(cfgYaml, domain, zone_list, nodeIndex, prefix_list, defaultRouter):
+                    sys.exit(1)
+
+        capacity = inventory.get('capacity')
+        if capacity and capacity.get('cluster') != variableJson['variable']['vsphere_cluster']['default']:
+            capacity = None
+        if not capacity:
+            print("No capacity data for cluster %s, all nodes go on datastore %s." % (variableJson['variable']['vsphere_cluster']['default'],
+                                                                                     variableJson['variable']['vsphere_datastore']['default']))
+
+        with self.tracer.phase('placement'):
+            placement = self.placeNodes(nodeIndex, self.getNodeSizing(cfgYaml), capacity,
+                                        variableJson['variable']['vsphere_datastore']['default'],
+                                        keepList=self.getSavedPlacement(variableSaveFile, nodeIndex))
+
+        for role in ['bootstrap', 'master', 'worker']:
+            for node_name, nic1, nic2 in nodeIndex[role]:
+                hostBlock, address_list = self.buildHostBlock(node_name, nic1, nic2)
+                hostBlock[node_name].update(placement[node_name])
+                variableJson['variable'][role + '_spec']['default'].update(hostBlock)
+                ignJobs.append((node_name, role, prefix_list, address_list,
+                                domain, defaultRouter, variableJson['variable']['ip_dns']['default']))
+
+        variableJson['variable'].update({'master_count': {'default': len(nodeIndex['master'])}})
+        variableJson['variable'].update({'worker_count': {'default': len(nodeIndex['worker'])}})
+
+        # The NSX load balancer variables come from the same install config and zone
+        if self.nsxDir:
+            nsxJson = self.buildNsxVariables(cfgYaml, nodeIndex, self.getNsxAnswers())
+
+        with self.tracer.phase('ignition_render'):
+            self.renderIgnitions(ignJobs)
+
+        try:
+            with self.tracer.phase('file_write'):
+                if not self.writeIfChanged(variableSaveFile, json.dumps(variableJson, indent=4) + "\n"):
+                    print("Terraform variables unchanged.")
+                if nsxJson and not self.writeIfChanged(self.nsxDir + '/variables.tf.json', json.dumps(nsxJson, indent=4) + "\n"):
+                    print("NSX variables unchanged.")
+        except OSError as e:
+                print("Could not write variable file: %s" % str(e))
+                sys.exit(1)
+
+    def addWorkerNodes(self):
+        variableSaveFile = self.outputDir + '/variables.tf.json'
+        ignJobs = []
+
+        try:
+            with open(variableSaveFile, 'r') as varFile:
+                variableJson = json.load(varFile)
+        except (OSError, ValueError) as e:
+            print("Can not open variable file: %s" % str(e))
+            sys.exit(1)
+
+        variables = variableJson['variable']
+        if not self.installDir:
+            self.installDir = variables['install_dir']['default']
+        self.dualNic = 'nic2' in variables['vsphere_network']['default']
+        domain = variables['cluster_name']['default'] + '.' + variables['domain_name']['default']
+
+        if 'ip_prefix_list' in variables:
+            prefix_list = variables['ip_prefix_list']['default']
+        else:
+            prefix_list = [variables['ip_prefix']['default']]
             if self.dualNic:
-                if 'bootstrap-lb' in zone_list:
-                    hostBlock['bootstrap']['nic2'] = {}
-                    hostBlock['bootstrap']['nic2']['ip_address'] = zone_list['bootstrap-lb']
-                    address_list.append(zone_list['bootstrap-lb'])
-            variableJson['variable']['bootstrap_spec']['default'].update(hostBlock)
-            self.updateIgn('bootstrap', 'bootstrap', prefix_list, address_list,
-                           domain, defaultRouter, variableJson['variable']['ip_dns']['default'])
-
-        index = -1
-        while True:
-            index = index + 1
-            node_name = "master" + str(index)
-            if node_name in zone_list:
-                foundMaster = True
-                masterCount = masterCount + 1
-                address_list = []
-                hostBlock = {node_name: {}}
-                hostBlock[node_name]['host_name'] = node_name
-                hostBlock[node_name]['nic1'] = {}
-                hostBlock[node_name]['nic1']['ip_address'] = zone_list[node_name]
-                address_list.append(zone_list[node_name])
-                if self.dualNic:
-                    lb_node_name = node_name + '-lb'
-                    if lb_node_name in zone_list:
-                        hostBlock[node_name]['nic2'] = {}
-                        hostBlock[node_name]['nic2']['ip_address'] = zone_list[lb_node_name]
-                        address_list.append(zone_list[lb_node_name])
-                variableJson['variable']['master_spec']['default'].update(hostBlock)
-                self.updateIgn(node_name, 'master', prefix_list, address_list,
-                               domain, defaultRouter, variableJson['variable']['ip_dns']['default'])
+                prefix_list.append(self.getPrefixLength())
+            variables.update({'ip_prefix_list': {'type': 'list(string)', 'default': prefix_list}})
+
+        try:
+            with self.tracer.phase('dns'):
+                zone, dnsList = self.getZone(domain)
+            zone_list = self.zoneAddresses(zone)
+        except Exception as e:
+            print("Could not query domain %s: %s" % (domain, str(e)))
+            sys.exit(1)
+
+        workerSpec = variables['worker_spec']['default']
+        nodeIndex = self.buildNodeIndex(zone_list)
+        newWorkers = [node for node in nodeIndex['worker'] if node[0] not in workerSpec]
+
+        # The new workers are checked with the nodes already deployed, the install config
+        # is not needed as the machine network is known from the variables
+        if newWorkers and not self.skipValidate:
+            expectedCount = {'bootstrap': 0, 'master': len(variables['master_spec']['default']), 'worker': len(workerSpec) + len(newWorkers)}
+            with self.tracer.phase('validate'):
+                if not self.validateCluster(self.getSavedConfig(variables), domain, zone_list, nodeIndex, prefix_list,
+                                            variables['ip_route']['default'], expectedCount):
+                    sys.exit(1)
+
+        # Variable files written before node placement keep the sizes from main.tf
+        placement = {}
+        if newWorkers and workerSpec and all(['datastore' in spec for spec in workerSpec.values()]):
+            sizing = {'worker': {key: list(workerSpec.values())[0][key] for key in ['num_cpus', 'memory', 'disk_size']}}
+            placedList = list(variables['master_spec']['default'].values()) + list(workerSpec.values())
+            with self.tracer.phase('placement'):
+                placement = self.placeNodes({'worker': newWorkers}, sizing,
+                                            self.getSavedCapacity(variables['vsphere_server']['default'],
+                                                                  variables['vsphere_datacenter']['default'],
+                                                                  variables['vsphere_cluster']['default']),
+                                            variables['vsphere_datastore']['default'], placedList)
+
+        for node_name, nic1, nic2 in newWorkers:
+            hostBlock, address_list = self.buildHostBlock(node_name, nic1, nic2)
+            hostBlock[node_name].update(placement.get(node_name, {}))
+            workerSpec.update(hostBlock)
+            ignJobs.append((node_name, 'worker', prefix_list, address_list,
+                            domain, variables['ip_route']['default'], variables['ip_dns']['default']))
+
+        if not ignJobs:
+            print("No new workers found for domain %s." % domain)
+            return
+
+        variables.update({'worker_count': {'default': len(workerSpec)}})
+
+        with self.tracer.phase('ignition_render'):
+            self.renderIgnitions(ignJobs)
+
+        try:
+            with self.tracer.phase('file_write'):
+                self.writeIfChanged(variableSaveFile, json.dumps(variableJson, indent=4) + "\n")
+        except OSError as e:
+            print("Could not write variable file: %s" % str(e))
+            sys.exit(1)
+
+        print("Added %d workers: %s" % (len(ignJobs), ' '.join([job[0] for job in ignJobs])))
+
+    def validateConfig(self):
+        import yaml
+
+        try:
+            with open(self.cfgFile, 'r') as cfgYamlFile, self.tracer.phase('yaml_parse'):
+                cfgYaml = yaml.safe_load(cfgYamlFile)
+        except OSError as e:
+            print("Can not open install config file: %s" % str(e))
+            sys.exit(1)
+
+        domain = cfgYaml['metadata']['name'] + '.' + cfgYaml['baseDomain']
+        prefix_list = [str(ipaddress.ip_network(cfgYaml['networking']['machineNetwork'][0]['cidr']).prefixlen)]
+        if self.dualNic:
+            prefix_list.append(self.getPrefixLength())
+
+        try:
+            with self.tracer.phase('dns'):
+                zone, dnsList = self.getZone(domain)
+            zone_list = self.zoneAddresses(zone)
+        except Exception as e:
+            print("Could not query domain %s: %s" % (domain, str(e)))
+            sys.exit(1)
+
+        router = self.answers.get('router')
+        routerNode = 'bootstrap-lb' if self.dualNic else 'bootstrap'
+        if not router and routerNode in zone_list:
+            router = '.'.join(zone_list[routerNode].split('.')[:-1] + ["1"])
+
+        with self.tracer.phase('validate'):
+            if not self.validateCluster(cfgYaml, domain, zone_list, self.buildNodeIndex(zone_list), prefix_list, router):
+                sys.exit(1)
+
+    def validateCluster(self, cfgYaml, domain, zone_list, nodeIndex, prefix_list, router, expectedCount = None):
+        import asyncio
+        import dns.reversename
+
+        problems = []
+        checkCount = 0
+        addressIndex = {}
+        machineNetworks = [ipaddress.ip_network(network['cidr']) for network in cfgYaml['networking']['machineNetwork']]
+        vsphere = cfgYaml['platform']['vsphere']
+        nodeList = nodeIndex['bootstrap'] + nodeIndex['master'] + nodeIndex['worker']
+        lbNetwork = None
+
+        if not expectedCount:
+            expectedCount = {'bootstrap': 1, 'master': cfgYaml['controlPlane']['replicas'], 'worker': cfgYaml['compute'][0]['replicas']}
+
+        for role in ['bootstrap', 'master', 'worker']:
+            expected = expectedCount[role]
+            checkCount += 1
+            if len(nodeIndex[role]) < expected:
+                problems.append("%d %s records found, the install config needs %d" % (len(nodeIndex[role]), role, expected))
+
+        for record, vip in [('api', vsphere.get('apiVIP')), ('api-int', vsphere.get('apiVIP')), ('*.apps', vsphere.get('ingressVIP'))]:
+            checkCount += 1
+            if record not in zone_list:
+                problems.append("%s: no A record" % record)
+            elif vip and zone_list[record] != vip:
+                problems.append("%s: address %s does not match the install config VIP %s" % (record, zone_list[record], vip))
+
+        # The bootstrap record may be gone once the cluster is up, any node with a -lb record will do
+        lbList = [nic2 for node_name, nic1, nic2 in nodeList if nic2]
+        if self.dualNic and lbList and len(prefix_list) > 1:
+            lbNetwork = ipaddress.ip_network(lbList[0] + '/' + str(prefix_list[1]), strict=False)
+
+        for node_name, nic1, nic2 in nodeList:
+            address = ipaddress.ip_address(nic1)
+            addressIndex.setdefault(address, []).append(node_name)
+            checkCount += 1
+            if not [network for network in machineNetworks if address in network]:
+                problems.append("%s: address %s is not in the machine network %s" % (node_name, nic1, ', '.join(map(str, machineNetworks))))
+            if not self.dualNic:
+                continue
+            checkCount += 1
+            if not nic2:
+                problems.append("%s: no %s-lb record for the second interface" % (node_name, node_name))
+                continue
+            lbAddress = ipaddress.ip_address(nic2)
+            addressIndex.setdefault(lbAddress, []).append(node_name + '-lb')
+            if lbNetwork and lbAddress not in lbNetwork:
+                problems.append("%s-lb: address %s is not in the second interface network %s" % (node_name, nic2, lbNetwork))
+
+        for vipKey in ['apiVIP', 'ingressVIP']:
+            if vsphere.get(vipKey):
+                checkCount += 1
+                if ipaddress.ip_address(vsphere[vipKey]) in addressIndex:
+                    problems.append("%s %s is also used by %s" % (vipKey, vsphere[vipKey], ', '.join(addressIndex[ipaddress.ip_address(vsphere[vipKey])])))
+
+        for address in sorted(addressIndex):
+            checkCount += 1
+            if len(addressIndex[address]) > 1:
+                problems.append("address %s is used by %s" % (address, ', '.join(addressIndex[address])))
+
+        # buildNodeIndex skips -lb records without a node record, so they are found here
+        for name in sorted(zone_list):
+            match = NODE_PATTERN.match(name)
+            if match and match.group(3):
+                checkCount += 1
+                if name[:-3] not in zone_list:
+                    problems.append("%s: no %s record for this second interface record" % (name, name[:-3]))
+
+        if router:
+            checkCount += 1
+            routerNetworks = [lbNetwork] if lbNetwork else machineNetworks
+            try:
+                routerAddress = ipaddress.ip_address(router)
+            except ValueError:
+                problems.append("router %s is not an IP address" % router)
             else:
-                break
-
-            index = -1
-            while True:
-                index = index + 1
-                node_name = "worker" + str(index)
-                if node_name in zone_list:
-                    foundWorker = True
-                    workerCount = workerCount + 1
-                    address_list = []
-                    hostBlock = {node_name: {}}
-                    hostBlock[node_name]['host_name'] = node_name
-                    hostBlock[node_name]['nic1'] = {}
-                    hostBlock[node_name]['nic1']['ip_address'] = zone_list[node_name]
-                    address_list.append(zone_list[node_name])
-                    if self.dualNic:
-                        lb_node_name = node_name + '-lb'
-                        if lb_node_name in zone_list:
-                            hostBlock[node_name]['nic2'] = {}
-                            hostBlock[node_name]['nic2']['ip_address'] = zone_list[lb_node_name]
-                            address_list.append(zone_list[lb_node_name])
-                    variableJson['variable']['worker_spec']['default'].update(hostBlock)
-                    self.updateIgn(node_name, 'worker', prefix_list, address_list,
-                                   domain, defaultRouter, variableJson['variable']['ip_dns']['default'])
-                else:
-                    break
+                if not [network for network in routerNetworks if routerAddress in network]:
+                    problems.append("router %s is not in %s" % (router, ', '.join(map(str, routerNetworks))))
+
+        # The zone copy may be correct while the servers the nodes use are not
+        if not self.offline and not self.zoneFile:
+            queries = [(record + '.' + domain, 'A') for record in ['api', 'api-int'] if record in zone_list]
+            queries += [(node_name + '.' + domain, 'A') for node_name, nic1, nic2 in nodeList]
+            queries += [(dns.reversename.from_address(nic1), 'PTR') for node_name, nic1, nic2 in nodeList]
+            discovery = dnsDiscovery(self.dnsConcurrency, self.dnsTimeout)
+            answers = asyncio.run(discovery.lookupAll(queries))
+            checkCount += len(queries)
+
+            forwardCount = len(queries) - len(nodeList)
+            for (name, rdtype), answer in zip(queries[:forwardCount], answers[:forwardCount]):
+                expected = zone_list[name[:-len(domain) - 1]]
+                if isinstance(answer, Exception):
+                    problems.append("%s: forward lookup failed: %s" % (name, answer.__class__.__name__))
+                elif expected not in [rdata.address for rdata in answer]:
+                    problems.append("%s: resolves to %s, the zone has %s" % (name, ', '.join([rdata.address for rdata in answer]), expected))
+
+            for (node_name, nic1, nic2), answer in zip(nodeList, answers[forwardCount:]):
+                fqdn = node_name + '.' + domain + '.'
+                if isinstance(answer, Exception):
+                    problems.append("%s: no PTR record for %s" % (node_name, nic1))
+                elif fqdn not in [rdata.target.to_text() for rdata in answer]:
+                    problems.append("%s: PTR for %s is %s" % (node_name, nic1, ', '.join([rdata.target.to_text() for rdata in answer])))
+
+        print("Pre-flight checks for %s: %d checks, %d problems." % (domain, checkCount, len(problems)))
+        for problem in problems:
+            print("  %s" % problem)
+
+        return not problems
+
+    def zoneAddresses(self, zone):
+        zone_list = {}
+        for name, ttl, rdata in zone.iterate_rdatas("A"):
+            zone_list.update({name.to_text(): rdata.to_text()})
+        return zone_list
+
+    def writeTraceReport(self):
+        spans = []
+        totals = {}
+
+        if not self.traceFile:
+            print("A trace file is required.")
+            sys.exit(1)
+
+        try:
+            with open(self.traceFile, 'r') as traceFile:
+                for line in traceFile:
+                    if line.strip():
+                        spans.append(json.loads(line))
+        except (OSError, ValueError) as e:
+            print("Can not read trace file: %s" % str(e))
+            sys.exit(1)
+
+        for span in spans:
+            key = (span['source'], span['phase'])
+            entry = totals.setdefault(key, {'duration': 0.0, 'count': 0, 'status': 0})
+            entry['duration'] += span['duration']
+            entry['count'] += 1
+            entry['status'] = max(entry['status'], span['status'])
+
+        for source, phase in sorted(totals, key=lambda key: -totals[key]['duration']):
+            entry = totals[(source, phase)]
+            print("%-20s %-28s %10.3f s %4d %s" % (source, phase, entry['duration'], entry['count'],
+                                                   'ok' if entry['status'] == 0 else 'failed'))
+
+        if not self.promFile:
+            return
+
+        labelBase = 'cluster="%s",' % self.traceCluster if self.traceCluster else ''
+        lines = []
+        lines.append('# HELP openshift_helper_phase_duration_seconds Time spent in each install phase.')
+        lines.append('# TYPE openshift_helper_phase_duration_seconds gauge')
+        for source, phase in sorted(totals):
+            lines.append('openshift_helper_phase_duration_seconds{%ssource="%s",phase="%s"} %.6f' %
+                         (labelBase, source, phase, totals[(source, phase)]['duration']))
+        lines.append('# HELP openshift_helper_phase_status Exit status of each install phase, 0 is success.')
+        lines.append('# TYPE openshift_helper_phase_status gauge')
+        for source, phase in sorted(totals):
+            lines.append('openshift_helper_phase_status{%ssource="%s",phase="%s"} %d' %
+                         (labelBase, source, phase, totals[(source, phase)]['status']))
+
+        # Written under a temporary name so the textfile collector never reads a partial file
+        try:
+            self.replaceFile(self.promFile, "\n".join(lines) + "\n")
+        except OSError as e:
+            print("Can not write Prometheus textfile: %s" % str(e))
+            sys.exit(1)
+
+    def writeIfChanged(self, fileName, text):
+        try:
+            with open(fileName, 'r') as currentFile:
+                if currentFile.read() == text:
+                    return False
+        except OSError:
+            pass
+
+        self.replaceFile(fileName, text)
+        return True
 
-            variableJson['variable'].update({'master_count': {'default': masterCount}})
-            variableJson['variable'].update({'worker_count': {'default': workerCount}})
+    def buildNodeIndex(self, zone_list):
+        nodeIndex = {'bootstrap': {}, 'master': {}, 'worker': {}}
 
+        for name, address in zone_list.items():
+            match = NODE_PATTERN.match(name)
+            if not match:
+                continue
+            role, ordinal, lb = match.groups()
+            if (role == 'bootstrap') != (ordinal == ''):
+                continue
+            entry = nodeIndex[role].setdefault(role + ordinal, {'ordinal': int(ordinal or 0), 'nic1': None, 'nic2': None})
+            if lb:
+                entry['nic2'] = address
+            else:
+                entry['nic1'] = address
+
+        # Ordered by ordinal, gaps in the numbering are allowed
+        for role in nodeIndex:
+            nodeList = sorted(nodeIndex[role].items(), key=lambda item: (item[1]['ordinal'], item[0]))
+            nodeIndex[role] = [(name, entry['nic1'], entry['nic2']) for name, entry in nodeList if entry['nic1']]
+
+        return nodeIndex
+
+    def buildHostBlock(self, node_name, nic1, nic2 = None):
+        address_list = [nic1]
+        hostBlock = {node_name: {}}
+        hostBlock[node_name]['host_name'] = node_name
+        hostBlock[node_name]['nic1'] = {}
+        hostBlock[node_name]['nic1']['ip_address'] = nic1
+        if self.dualNic and nic2:
+            hostBlock[node_name]['nic2'] = {}
+            hostBlock[node_name]['nic2']['ip_address'] = nic2
+            address_list.append(nic2)
+        return hostBlock, address_list
+
+    def getNodeSizing(self, cfgYaml):
+        sizing = {}
+        poolList = {}
+        poolList['master'] = cfgYaml.get('controlPlane') or {}
+        poolList['bootstrap'] = poolList['master']
+        poolList['worker'] = (cfgYaml.get('compute') or [{}])[0]
+
+        # The machine pool sizes of the install config, with the sizes main.tf used before as defaults
+        for role, pool in poolList.items():
+            vsphere = (pool.get('platform') or {}).get('vsphere') or {}
+            sizing[role] = {}
+            sizing[role]['num_cpus'] = int(vsphere.get('cpus', 4))
+            sizing[role]['memory'] = int(vsphere.get('memoryMB', 16384))
+            sizing[role]['disk_size'] = int((vsphere.get('osDisk') or {}).get('diskSizeGB', 100))
+
+        return sizing
+
+    def placeNodes(self, nodeIndex, sizing, capacity, defaultDatastore, placedList = [], keepList = {}):
+        freeSpace = {}
+        freeMemory = {}
+        ssdList = set()
+        maxCores = None
+
+        if capacity:
+            allowList = self.answers.get('datastores')
+            for datastore in capacity['datastores']:
+                if allowList and datastore['name'] not in allowList:
+                    continue
+                freeSpace[datastore['name']] = datastore['free'] // 1073741824
+                if datastore.get('ssd'):
+                    ssdList.add(datastore['name'])
+            for host in capacity['hosts']:
+                freeMemory[host['name']] = host['memory'] - host['memory_used']
+            if capacity['hosts']:
+                maxCores = min([host['cores'] for host in capacity['hosts']])
+
+        # Without capacity data the nodes are spread over what is already in use, by count only
+        capacityKnown = bool(freeSpace)
+        if not capacityKnown:
+            freeSpace = {spec['datastore']: 0 for spec in placedList if spec.get('datastore')}
+            freeSpace = freeSpace or {defaultDatastore: 0}
+        if not freeMemory:
+            freeMemory = {spec['host']: 0 for spec in placedList if spec.get('host')}
+
+        datastoreCount = {name: 0 for name in freeSpace}
+        hostCount = {name: 0 for name in freeMemory}
+
+        # The capacity may predate the nodes already placed, so their share is taken off
+        for spec in placedList:
+            if spec.get('datastore') in freeSpace:
+                datastoreCount[spec['datastore']] += 1
+                if capacityKnown:
+                    freeSpace[spec['datastore']] -= spec['disk_size']
+            if spec.get('host') in freeMemory:
+                hostCount[spec['host']] += 1
+                if capacity:
+                    freeMemory[spec['host']] -= spec['memory']
+
+        placement = {}
+        shortList = set()
+        sizeList = {}
+        roleDatastores = {}
+        roleHosts = {}
+
+        # Nodes that are already deployed keep their datastore and host, moving them would
+        # relocate running VMs. They are counted before any new node is placed.
+        for role in ['master', 'bootstrap', 'worker']:
+            if not nodeIndex.get(role):
+                continue
+            sizeList[role] = dict(sizing[role])
+            if maxCores and sizeList[role]['num_cpus'] > maxCores:
+                print("Reducing %s vCPUs from %d to %d, the smallest host has %d cores." % (role, sizeList[role]['num_cpus'], maxCores, maxCores))
+                sizeList[role]['num_cpus'] = maxCores
+            roleDatastores[role] = set()
+            roleHosts[role] = set()
+
+            for node_name, nic1, nic2 in nodeIndex[role]:
+                if node_name not in keepList:
+                    continue
+                size = sizeList[role]
+                datastore = keepList[node_name]['datastore']
+                host = keepList[node_name]['host']
+                if datastore in freeSpace:
+                    freeSpace[datastore] -= size['disk_size']
+                    datastoreCount[datastore] += 1
+                if host in freeMemory:
+                    freeMemory[host] -= size['memory']
+                    hostCount[host] += 1
+                roleDatastores[role].add(datastore)
+                if host:
+                    roleHosts[role].add(host)
+
+                placement[node_name] = dict(size)
+                placement[node_name]['datastore'] = datastore
+                placement[node_name]['host'] = host
+
+        # Masters first so they get distinct hosts and datastores, flash first for etcd among those.
+        # The others go where the free space per node already placed is largest, which
+        # spreads them evenly while larger datastores and hosts take a larger share.
+        newCount = 0
+        for role in ['master', 'bootstrap', 'worker']:
+            if not nodeIndex.get(role):
+                continue
+            size = sizeList[role]
+            spread = role == 'master'
+            for node_name, nic1, nic2 in nodeIndex[role]:
+                if node_name in placement:
+                    continue
+                newCount += 1
+                datastore = min(freeSpace, key=lambda name: (spread and name in roleDatastores[role], spread and name not in ssdList,
+                                                             -freeSpace[name] / (datastoreCount[name] + 1), datastoreCount[name], name))
+                if capacityKnown and freeSpace[datastore] < size['disk_size']:
+                    shortList.add("datastore " + datastore)
+                freeSpace[datastore] -= size['disk_size']
+                datastoreCount[datastore] += 1
+                roleDatastores[role].add(datastore)
+
+                host = ''
+                if freeMemory:
+                    host = min(freeMemory, key=lambda name: (spread and name in roleHosts[role], -freeMemory[name] / (hostCount[name] + 1),
+                                                             hostCount[name], name))
+                    if capacity and freeMemory[host] < size['memory']:
+                        shortList.add("host " + host)
+                    freeMemory[host] -= size['memory']
+                    hostCount[host] += 1
+                    roleHosts[role].add(host)
+
+                placement[node_name] = dict(size)
+                placement[node_name]['datastore'] = datastore
+                placement[node_name]['host'] = host
+
+            if spread and capacityKnown and len(roleDatastores[role]) < len(nodeIndex[role]):
+                print("Warning: %d masters share %d datastores." % (len(nodeIndex[role]), len(roleDatastores[role])))
+            if spread and freeMemory and len(roleHosts[role]) < len(nodeIndex[role]):
+                print("Warning: %d masters share %d hosts." % (len(nodeIndex[role]), len(roleHosts[role])))
+
+        for name in sorted(shortList):
+            print("Warning: %s is overcommitted by this placement." % name)
+
+        print("Placed %d new nodes, %d kept, on %d datastores and %d hosts." % (newCount, len(placement) - newCount,
+                                                                               len(set([spec['datastore'] for spec in placement.values()])),
+                                                                               len(set([spec['host'] for spec in placement.values() if spec['host']]))))
+        return placement
+
+    def getSavedConfig(self, variables):
+        nodeSpec = list(variables['master_spec']['default'].values()) + list(variables['worker_spec']['default'].values())
+        machineNetwork = ipaddress.ip_network(nodeSpec[0]['nic1']['ip_address'] + '/' + str(variables['ip_prefix']['default']), strict=False)
+
+        cfgYaml = {}
+        cfgYaml['networking'] = {'machineNetwork': [{'cidr': str(machineNetwork)}]}
+        cfgYaml['platform'] = {'vsphere': {}}
+        return cfgYaml
+
+    def getSavedPlacement(self, variableSaveFile, nodeIndex):
+        try:
+            with open(variableSaveFile, 'r') as varFile:
+                variables = json.load(varFile)['variable']
+        except (OSError, ValueError, KeyError):
+            return {}
+
+        # Only a node that keeps its role keeps its place
+        keepList = {}
+        for role in ['bootstrap', 'master', 'worker']:
+            savedSpec = variables.get(role + '_spec', {}).get('default', {})
+            for node_name, nic1, nic2 in nodeIndex[role]:
+                if 'datastore' in savedSpec.get(node_name, {}):
+                    keepList[node_name] = {'datastore': savedSpec[node_name]['datastore'],
+                                           'host': savedSpec[node_name].get('host', '')}
+        return keepList
+
+    def getInventoryCacheFile(self, server, datacenterName):
+        cacheKey = re.sub('[^A-Za-z0-9_.-]', '_', server + '_' + datacenterName)
+        return self.cacheDir + '/inventory/' + cacheKey + '.json'
+
+    def getSavedCapacity(self, server, datacenterName, clusterName):
+        # Adding workers does not connect to vCenter, the last discovery is close enough
+        savedFile = self.inventoryFile or self.getInventoryCacheFile(server, datacenterName)
+        try:
+            with open(savedFile, 'r') as cacheFile:
+                capacity = json.load(cacheFile).get('capacity')
+        except (OSError, ValueError):
+            return None
+        if capacity and capacity.get('cluster') == clusterName:
+            return capacity
+        return None
+
+    def getInventory(self, server, user, password, datacenterName, clusterName):
+        inventoryCacheFile = self.getInventoryCacheFile(server, datacenterName)
+
+        # A saved inventory is used as is, however old it is
+        if self.inventoryFile or self.offline:
+            savedFile = self.inventoryFile or inventoryCacheFile
+            try:
+                with open(savedFile, 'r') as cacheFile:
+                    inventory = json.load(cacheFile)
+                if 'dvs' not in inventory or 'portgroups' not in inventory:
+                    raise ValueError("switch or port group list missing")
+            except (OSError, ValueError) as e:
+                print("Can not read saved inventory %s: %s" % (savedFile, str(e)))
+                sys.exit(1)
+            return inventory
+
+        if not self.refreshInventory and os.path.exists(inventoryCacheFile):
+            try:
+                with open(inventoryCacheFile, 'r') as cacheFile:
+                    inventory = json.load(cacheFile)
+                # Caches from before capacity discovery, or for another cluster, are read again.
+                # The cluster asked for is kept, so a cluster without capacity data still hits.
+                if time.time() - inventory['timestamp'] < self.inventoryTtl and inventory.get('cluster') == clusterName:
+                    return inventory
+            except (OSError, ValueError, KeyError) as e:
+                print("Ignoring unreadable inventory cache %s: %s" % (inventoryCacheFile, str(e)))
+
+        with self.tracer.phase('vcenter_connect'):
+            si = self.connectVsphere(server, user, password)
 
-            if not foundMaster or not foundWorker or not foundBootstrap:
-                print("Could not find all required nodes for domain %s." % domain)
+        try:
+            collector = vsphereInventory(si.RetrieveContent())
+            datacenter = collector.getDatacenter(datacenterName)
+            if not datacenter:
+                print("Datacenter %s not found." % datacenterName)
                 sys.exit(1)
 
+            inventory = {}
+            inventory['timestamp'] = time.time()
+            inventory['vcenter'] = server
+            inventory['datacenter'] = datacenterName
+            inventory['cluster'] = clusterName
+            inventory['dvs'], inventory['portgroups'] = collector.getNetworks(datacenter)
+            with self.tracer.phase('capacity'):
+                inventory['capacity'] = collector.getCapacity(datacenter, clusterName)
+        finally:
+            self.disconnectVsphere(si)
+
+        try:
+            os.makedirs(os.path.dirname(inventoryCacheFile), exist_ok=True)
+            self.replaceFile(inventoryCacheFile, json.dumps(inventory, indent=4) + "\n")
+        except OSError as e:
+            print("Can not write inventory cache: %s" % str(e))
+
+        return inventory
+
+    def connectVsphere(self, server, user, password):
+        import ssl
+        from pyVim.connect import SmartConnectNoSSL, SmartStubAdapter
+        from pyVmomi import vim
+
+        sessionKey = re.sub('[^A-Za-z0-9_.-]', '_', server + '_' + user)
+        sessionFile = self.cacheDir + '/sessions/' + sessionKey + '.cookie'
+
+        if self.reuseSession and os.path.exists(sessionFile):
             try:
-                with open(variableSaveFile, 'w') as saveFile:
-                    json.dump(variableJson, saveFile, indent=4)
-                    saveFile.write("\n")
-                    saveFile.close()
+                with open(sessionFile, 'r') as cookieFile:
+                    cookie = cookieFile.read().strip()
+                stub = SmartStubAdapter(host=server, port=443, sslContext=ssl._create_unverified_context())
+                stub.cookie = cookie
+                si = vim.ServiceInstance('ServiceInstance', stub)
+                if si.RetrieveContent().sessionManager.currentSession:
+                    return si
+            except Exception:
+                pass
+
+        try:
+            si = SmartConnectNoSSL(host=server, user=user, pwd=password, port=443)
+        except Exception as e:
+            print("Can not connect to vCenter %s: %s" % (server, str(e)))
+            sys.exit(1)
+
+        if self.reuseSession:
+            try:
+                os.makedirs(os.path.dirname(sessionFile), mode=0o700, exist_ok=True)
+                cookieFd = os.open(sessionFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(cookieFd, 'w') as cookieFile:
+                    cookieFile.write(si._stub.cookie + "\n")
             except OSError as e:
-                    print("Could not write variable file: %s" % str(e))
-                    sys.exit(1)
+                print("Can not save vCenter session: %s" % str(e))
+
+        return si
+
+    def disconnectVsphere(self, si):
+        from pyVim.connect import Disconnect
+
+        # A stored session stays logged in so the next run can use it
+        if self.reuseSession:
+            return
+        Disconnect(si)
+
+    def getZone(self, domain):
+        import io
+        import asyncio
+        import dns.query
+        import dns.zone
+        import dns.xfr
+
+        zoneCacheFile = self.cacheDir + '/zones/' + domain + '.zone'
+        zone = None
+        zoneSerial = None
+
+        if self.zoneFile or self.offline:
+            return self.getSavedZone(domain, self.zoneFile or zoneCacheFile)
+
+        if not self.refreshZone and os.path.exists(zoneCacheFile):
+            try:
+                zone = dns.zone.from_file(zoneCacheFile, origin=domain, relativize=True)
+                zoneSerial = zone.find_rdataset('@', 'SOA')[0].serial
+            except Exception as e:
+                print("Ignoring unreadable zone cache %s: %s" % (zoneCacheFile, str(e)))
+                zone = None
+
+        discovery = dnsDiscovery(self.dnsConcurrency, self.dnsTimeout)
+        soa_serial, master_addr, dnsList = asyncio.run(discovery.zoneServers(domain))
+
+        if zone and zoneSerial == soa_serial:
+            return zone, dnsList
+
+        if zone:
+            try:
+                xfr_query, xfr_serial = dns.xfr.make_query(zone)
+                dns.query.inbound_xfr(master_addr, zone, xfr_query)
+            except Exception:
+                zone = None
+
+        if not zone:
+            xfr_answer = dns.query.xfr(master_addr, domain)
+            zone = dns.zone.from_xfr(xfr_answer)
 
-    def getVarValue(self):
+        try:
+            os.makedirs(os.path.dirname(zoneCacheFile), exist_ok=True)
+            zoneText = io.StringIO()
+            zone.to_file(zoneText, want_origin=True)
+            self.replaceFile(zoneCacheFile, zoneText.getvalue())
+        except OSError as e:
+            print("Can not write zone cache: %s" % str(e))
+
+        return zone, dnsList
+
+    def getSavedZone(self, domain, zoneFile):
+        import dns.zone
+
+        zone = dns.zone.from_file(zoneFile, origin=domain, relativize=True)
+
+        if 'dns' in self.answers:
+            return zone, [str(address) for address in self.answers['dns']]
+
+        # Without answers the name servers must have addresses in the zone itself
+        dnsList = []
+        for rdata in zone.find_rdataset('@', 'NS'):
+            try:
+                dnsList.append(zone.find_rdataset(rdata.target, 'A')[0].address)
+            except KeyError:
+                raise ValueError("no address for name server %s in %s, add dns to the answers file" % (rdata.target, zoneFile))
+        return zone, sorted(dnsList)
+
+    def getVarValues(self):
         variableFile = self.outputDir + '/variables.tf.json'
+        results = []
 
         try:
             with open(variableFile, 'r') as tfVars:
                 tfVarJson = json.load(tfVars)
-                for key in tfVarJson['variable']:
-                    if key == self.getValue:
-                        print(tfVarJson['variable'][key]['default'])
         except OSError as e:
             print("Can not open terraform variable file: %s" % str(e))
             sys.exit(1)
 
-    def getYamlValue(self):
+        for name, key in self.parseQueryKeys():
+            keyList = key.split('.')
+            try:
+                pointer = tfVarJson['variable'][keyList[0]]['default']
+            except KeyError:
+                print("Key %s not found." % keyList[0])
+                sys.exit(1)
+            for item in keyList[1:]:
+                try:
+                    pointer = pointer[item]
+                except (KeyError, IndexError, TypeError):
+                    print("Key %s not found." % item)
+                    sys.exit(1)
+            results.append((name, pointer))
+
+        return results
+
+    def getYamlValues(self):
+        import yaml
+
         yamlFile = self.yamlFile
-        getArray = self.getValue.split('.')
         cfgYaml = None
-        num = len(getArray)
-        count = 1
-        pointer = {}
+        results = []
+        yamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
         try:
             with open(yamlFile, 'r') as configYaml:
-                cfgYaml = yaml.safe_load(configYaml)
+                cfgYaml = yaml.load(configYaml, Loader=yamlLoader)
                 configYaml.close()
         except OSError as e:
                 print("Can not open YAML file: %s" % str(e))
                 sys.exit(1)
 
-        pointer = cfgYaml
-        for key in getArray:
-            try:
-                pointer = pointer[key]
-            except:
-                print("Key %s not found." % key)
-                sys.exit(1)
-            if count == num:
-                return pointer
+        for name, key in self.parseQueryKeys():
+            pointer = cfgYaml
+            for item in key.split('.'):
+                if isinstance(pointer, list) and item.isdigit():
+                    item = int(item)
+                try:
+                    pointer = pointer[item]
+                except (KeyError, IndexError, TypeError):
+                    print("Key %s not found." % item)
+                    sys.exit(1)
+            results.append((name, pointer))
+
+        return results
+
+    def parseQueryKeys(self):
+        queryList = []
+
+        for item in self.getValue:
+            if '=' in item:
+                name, key = item.split('=', 1)
             else:
-                count = count + 1
+                name, key = re.sub('[^A-Za-z0-9_]', '_', item), item
+            queryList.append((name, key))
+
+        return queryList
+
+    def formatQueryValue(self, value):
+        if isinstance(value, (dict, list)):
+            return json.dumps(value)
+        return str(value)
+
+    def printQueryResults(self, results):
+        if self.outputFormat == 'json':
+            print(json.dumps({name: value for name, value in results}))
+        elif self.outputFormat == 'shell':
+            for name, value in results:
+                print("%s=%s" % (name, shlex.quote(self.formatQueryValue(value))))
+        else:
+            for name, value in results:
+                print(value)
 
     def generateNsxConfig(self):
-        variableJson = {}
-        variableJson['variable'] = {}
+        import yaml
+
         variableSaveFile = self.outputDir + '/variables.tf.json'
-        foundMaster = False
-        foundWorker = False
-        foundBootstrap = False
+        nsxAnswers = self.getNsxAnswers()
+
+        try:
+            with open(self.nsxCfgFile, 'r') as cfgYamlFile, self.tracer.phase('yaml_parse'):
+                cfgYaml = yaml.safe_load(cfgYamlFile)
+        except OSError as e:
+            print("Can not open install config file: %s" % str(e))
+            sys.exit(1)
 
-        useranswer = input("NSX Admin User: ")
-        useranswer = useranswer.rstrip("\n")
+        domain = cfgYaml['metadata']['name'] + '.' + cfgYaml['baseDomain']
+        try:
+            with self.tracer.phase('dns'):
+                zone, dnsList = self.getZone(domain)
+            zone_list = self.zoneAddresses(zone)
+        except Exception as e:
+            print("Could not query domain %s: %s" % (domain, str(e)))
+            sys.exit(1)
+
+        nodeIndex = self.buildNodeIndex(zone_list)
+
+        if not nodeIndex['bootstrap'] or not nodeIndex['master'] or not nodeIndex['worker']:
+            print("Could not find all required nodes for domain %s." % domain)
+            sys.exit(1)
+
+        variableJson = self.buildNsxVariables(cfgYaml, nodeIndex, nsxAnswers)
+
+        try:
+            with self.tracer.phase('file_write'):
+                self.writeIfChanged(variableSaveFile, json.dumps(variableJson, indent=4) + "\n")
+        except OSError as e:
+            print("Could not write variable file: %s" % str(e))
+            sys.exit(1)
 
-        passanswer = getpass.getpass()
-        passanswer = passanswer.rstrip("\n")
+    def getNsxAnswers(self):
+        nsxAnswers = {}
+        promptList = [('nsxt_user', "NSX Admin User: "),
+                      ('nsxt_password', None),
+                      ('nsxt_manager', "NSX Manager: "),
+                      ('edge_cluster', "Edge Cluster Name: "),
+                      ('segment_name', "Segment Name: "),
+                      ('segment_address', "Gateway Service Address: "),
+                      ('segment_router', "Gateway Default Router: ")]
+
+        for key, prompt in promptList:
+            if key in self.answers:
+                nsxAnswers[key] = str(self.answers[key])
+            elif prompt:
+                nsxAnswers[key] = input(prompt).rstrip("\n")
+            else:
+                nsxAnswers[key] = getpass.getpass().rstrip("\n")
+        return nsxAnswers
+
+    def selectItem(self, key, prompt, itemList):
+        if key in self.answers:
+            if self.answers[key] in itemList:
+                return self.answers[key]
+            print("Answer %s %s is not one of: %s" % (key, self.answers[key], ', '.join(itemList)))
+            sys.exit(1)
 
-        mgranswer = input("NSX Manager: ")
-        mgranswer = mgranswer.rstrip("\n")
+        while True:
+            for i in range(len(itemList)):
+                print(" %d) %s" % (i+1,itemList[i]))
+            selection = input("%s [%d-%d]: " % (prompt, 1, len(itemList)))
+            try:
+                int(selection)
+            except ValueError:
+                continue
+            if int(selection) < 1 or int(selection) > len(itemList):
+                continue
+            return itemList[int(selection)-1]
 
-        ecName = input("Edge Cluster Name: ")
-        ecName = ecName.rstrip("\n")
+    def getPrefixLength(self):
+        if 'nic2_prefix' in self.answers:
+            network_bits = str(self.answers['nic2_prefix'])
+            if not network_bits.isdigit() or int(network_bits) < 1 or int(network_bits) > 30:
+                print("Answer nic2_prefix %s is not a prefix length between 1 and 30." % network_bits)
+                sys.exit(1)
+            return network_bits
 
-        segmentName = input("Segment Name: ")
-        segmentName = segmentName.rstrip("\n")
+        while True:
+            network_bits = input("Network Prefix Length for second interface: ")
+            try:
+                int(network_bits)
+            except ValueError:
+                continue
+            if int(network_bits) < 1 or int(network_bits) > 30:
+                continue
+            return network_bits
 
-        addressName = input("Gateway Service Address: ")
-        addressName = addressName.rstrip("\n")
+    def loadAnswers(self):
+        if not self.answerFile:
+            return {}
 
-        routerName = input("Gateway Default Router: ")
-        routerName = routerName.rstrip("\n")
+        # Imported here so queries without an answers file do not pay for it
+        import yaml
 
         try:
-            with open(self.nsxCfgFile, 'r') as cfgYamlFile:
-                cfgYaml = yaml.safe_load(cfgYamlFile)
-                for key in cfgYaml:
-                    if key == 'platform':
-                        variableJson['variable'].update({'api_vip': {'default': cfgYaml['platform']['vsphere']['apiVIP']}})
-                        variableJson['variable'].update({'apps_vip': {'default': cfgYaml['platform']['vsphere']['ingressVIP']}})
-                    if key == 'baseDomain':
-                        variableJson['variable'].update({'domain_name': {'default': cfgYaml['baseDomain']}})
-                    if key == 'metadata':
-                        variableJson['variable'].update({'cluster_name': {'default': cfgYaml['metadata']['name']}})
-
-                variableJson['variable'].update({'nsxt_user': {'default': useranswer}})
-                variableJson['variable'].update({'nsxt_password': {'default': passanswer}})
-                variableJson['variable'].update({'nsxt_manager': {'default': mgranswer}})
-                variableJson['variable'].update({'edge_cluster': {'default': ecName}})
-                variableJson['variable'].update({'segment_name': {'default': segmentName}})
-                variableJson['variable'].update({'segment_address': {'default': addressName}})
-                variableJson['variable'].update({'segment_router': {'default': routerName}})
-
-                domain = variableJson['variable']['cluster_name']['default'] + '.' + variableJson['variable']['domain_name']['default']
+            with open(self.answerFile, 'r') as answerInput:
+                answers = yaml.safe_load(answerInput)
+        except (OSError, yaml.YAMLError) as e:
+            print("Can not read answers file: %s" % str(e))
+            sys.exit(1)
+
+        if not isinstance(answers, dict):
+            print("Answers file must contain a map of answers.")
+            sys.exit(1)
+        return answers
+
+    def buildNsxVariables(self, cfgYaml, nodeIndex, nsxAnswers):
+        variableJson = {}
+        variableJson['variable'] = {}
+        variableJson['variable'].update({'api_vip': {'default': cfgYaml['platform']['vsphere']['apiVIP']}})
+        variableJson['variable'].update({'apps_vip': {'default': cfgYaml['platform']['vsphere']['ingressVIP']}})
+        variableJson['variable'].update({'domain_name': {'default': cfgYaml['baseDomain']}})
+        variableJson['variable'].update({'cluster_name': {'default': cfgYaml['metadata']['name']}})
+
+        for key in ['nsxt_user', 'nsxt_password', 'nsxt_manager', 'edge_cluster', 'segment_name', 'segment_address', 'segment_router']:
+            variableJson['variable'].update({key: {'default': nsxAnswers[key]}})
+
+        # The bootstrap node is in the API pool with the masters until it is removed
+        variableJson['variable'].update({'master_list': {}})
+        variableJson['variable']['master_list']['type'] = 'list(string)'
+        variableJson['variable']['master_list']['default'] = [nic1 for node_name, nic1, nic2 in nodeIndex['bootstrap'] + nodeIndex['master']]
+        variableJson['variable'].update({'worker_list': {}})
+        variableJson['variable']['worker_list']['type'] = 'list(string)'
+        variableJson['variable']['worker_list']['default'] = [nic1 for node_name, nic1, nic2 in nodeIndex['worker']]
+
+        return variableJson
+
+    def updateConfig(self):
+        variableFile = self.outputDir + '/variables.tf.json'
+        updates = []
+
+        if self.setKey and self.setValue:
+            updates.append((self.setKey, self.setValue))
+
+        # key=value sets a string, key:=value sets a JSON value (number, boolean, list or map)
+        for item in self.updateList or []:
+            key, sep, value = item.partition('=')
+            if not sep or not key:
+                print("Update %s is not in key=value or key:=json form." % item)
+                sys.exit(1)
+            if key.endswith(':'):
                 try:
-                    soa_answer = dns.resolver.query(domain, "SOA", tcp=True)
-                    soa_host = soa_answer[0].mname
-
-                    master_answer = dns.resolver.query(soa_host, "A", tcp=True)
-                    master_addr = master_answer[0].address
-
-                    xfr_answer = dns.query.xfr(master_addr, domain)
-                    zone = dns.zone.from_xfr(xfr_answer)
-
-                    variableJson['variable'].update({'master_list': {}})
-                    variableJson['variable']['master_list']['type'] = 'list(string)'
-                    variableJson['variable']['master_list']['default'] = []
-                    variableJson['variable'].update({'worker_list': {}})
-                    variableJson['variable']['worker_list']['type'] = 'list(string)'
-                    variableJson['variable']['worker_list']['default'] = []
-                    for name, ttl, rdata in zone.iterate_rdatas("A"):
-                        pattern = re.compile("^master[0-9]+$")
-                        if pattern.match(name.to_text()):
-                            foundMaster = True
-                            variableJson['variable']['master_list']['default'].append(rdata.to_text())
-                        pattern = re.compile("^bootstrap$")
-                        if pattern.match(name.to_text()):
-                            foundBootstrap = True
-                            variableJson['variable']['master_list']['default'].append(rdata.to_text())
-                        pattern = re.compile("^worker[0-9]+$")
-                        if pattern.match(name.to_text()):
-                            foundWorker = True
-                            variableJson['variable']['worker_list']['default'].append(rdata.to_text())
-
-                except Exception as e:
-                    print("Could not query domain %s: %s" % (domain, str(e)))
+                    updates.append((key[:-1], json.loads(value)))
+                except ValueError as e:
+                    print("Can not parse JSON value for %s: %s" % (key[:-1], str(e)))
                     sys.exit(1)
+            else:
+                updates.append((key, value))
 
-                if not foundMaster or not foundWorker or not foundBootstrap:
-                    print("Could not find all required nodes for domain %s." % domain)
-                    sys.exit(1)
+        if self.batchFile:
+            try:
+                if self.batchFile == '-':
+                    batchJson = json.load(sys.stdin)
+                else:
+                    with open(self.batchFile, 'r') as batchInput:
+                        batchJson = json.load(batchInput)
+            except (OSError, ValueError) as e:
+                print("Can not read batch file: %s" % str(e))
+                sys.exit(1)
+            if not isinstance(batchJson, dict):
+                print("Batch file must contain a JSON object of keys and values.")
+                sys.exit(1)
+            updates.extend(batchJson.items())
 
-                try:
-                    with open(variableSaveFile, 'w') as saveFile:
-                        json.dump(variableJson, saveFile, indent=4)
-                        saveFile.write("\n")
-                        saveFile.close()
-                except OSError as e:
-                        print("Could not write variable file: %s" % str(e))
-                        sys.exit(1)
-        except OSError as e:
-            print("Can not open install config file: %s" % str(e))
+        if not updates:
+            return
+
+        # Held across the read and the write so concurrent updates are not lost
+        with self.lockFile(variableFile):
+            try:
+                with open(variableFile, 'r') as varFile:
+                    varFileJson = json.load(varFile)
+            except (OSError, ValueError) as e:
+                print("Can not open variable file: %s" % str(e))
+                sys.exit(1)
+
+            for key, value in updates:
+                self.setVarValue(varFileJson, key, value)
+
+            try:
+                self.replaceFile(variableFile, json.dumps(varFileJson, indent=4) + "\n")
+            except OSError as e:
+                print("Can not open variable file: %s" % str(e))
+                sys.exit(1)
+
+    def setVarValue(self, varFileJson, key, value):
+        keyList = key.split('.')
+
+        if len(keyList) == 1:
+            varFileJson['variable'].update({key: {}})
+            varFileJson['variable'][key]['default'] = value
+            return
+
+        try:
+            pointer = varFileJson['variable'][keyList[0]]['default']
+        except KeyError:
+            print("Key %s not found." % keyList[0])
             sys.exit(1)
 
-    def updateConfig(self):
-        variableFile = self.outputDir + '/variables.tf.json'
-        varFileJson = {}
+        # Missing map levels are created, list elements are addressed by index
+        for item in keyList[1:-1]:
+            try:
+                if isinstance(pointer, list):
+                    pointer = pointer[int(item)]
+                else:
+                    pointer = pointer.setdefault(item, {})
+            except (ValueError, IndexError, AttributeError):
+                print("Key %s not found." % item)
+                sys.exit(1)
 
         try:
-            with open(variableFile, 'r') as varFile:
-                varFileJson = json.load(varFile)
-            varFile.close()
-        except OSError as e:
-            print("Can not open variable file: %s" % str(e))
+            if isinstance(pointer, list):
+                pointer[int(keyList[-1])] = value
+            else:
+                pointer[keyList[-1]] = value
+        except (ValueError, IndexError, TypeError):
+            print("Key %s not found." % keyList[-1])
             sys.exit(1)
 
-        varFileJson['variable'].update({self.setKey: {}})
-        varFileJson['variable'][self.setKey]['default'] = self.setValue
+    @contextlib.contextmanager
+    def lockFile(self, fileName):
+        import fcntl
 
+        # A missing directory is reported here, before the variable file is read
         try:
-            with open(variableFile, 'w') as varFile:
-                json.dump(varFileJson, varFile, indent=4)
-                varFile.write("\n")
-                varFile.close()
+            lockFile = open(fileName + '.lock', 'a')
         except OSError as e:
             print("Can not open variable file: %s" % str(e))
             sys.exit(1)
 
+        with lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+    def replaceFile(self, fileName, text):
+        # A unique temporary file per writer, concurrent runs never share one
+        fileDir, baseName = os.path.split(os.path.abspath(fileName))
+        tempFd, tempFile = tempfile.mkstemp(dir=fileDir, prefix='.' + baseName + '.')
+
+        try:
+            with os.fdopen(tempFd, 'w') as newFile:
+                newFile.write(text)
+                newFile.flush()
+                os.fsync(newFile.fileno())
+            if os.path.exists(fileName):
+                os.chmod(tempFile, os.stat(fileName).st_mode & 0o7777)
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(tempFile, 0o666 & ~umask)
+            os.replace(tempFile, fileName)
+        except BaseException:
+            if os.path.exists(tempFile):
+                os.remove(tempFile)
+            raise
+
     def parse_args(self):
         parser = argparse.ArgumentParser()
         parser.add_argument('--file', action='store')
         parser.add_argument('--dir', action='store')
-        parser.add_argument('--get', action='store')
+        parser.add_argument('--get', action='store', nargs='+')
         parser.add_argument('--nsx', action='store')
+        parser.add_argument('--nsx-dir', action='store')
         parser.add_argument('--set', action='store')
         parser.add_argument('--value', action='store')
+        parser.add_argument('--update', action='store', nargs='+')
+        parser.add_argument('--batch', action='store')
         parser.add_argument('--install', action='store')
         parser.add_argument('--id', action='store')
         parser.add_argument('--template', action='store')
         parser.add_argument('--dual', action='store_true')
         parser.add_argument('--yaml', action='store')
+        parser.add_argument('--format', action='store', choices=['raw', 'shell', 'json'], default='raw')
+        parser.add_argument('--jobs', action='store', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--ign-url', action='store')
+        parser.add_argument('--serve', action='store_true')
+        parser.add_argument('--compress', action='store_true')
+        parser.add_argument('--force', action='store_true')
+        parser.add_argument('--add-workers', action='store_true')
+        parser.add_argument('--trace', action='store')
+        parser.add_argument('--trace-report', action='store_true')
+        parser.add_argument('--prom', action='store')
+        parser.add_argument('--cluster', action='store')
+        parser.add_argument('--cache-dir', action='store', default=os.environ.get('HOME', '/var/tmp') + '/.openshift-helper')
+        parser.add_argument('--refresh-zone', action='store_true')
+        parser.add_argument('--refresh-inventory', action='store_true')
+        parser.add_argument('--reuse-session', action='store_true')
+        parser.add_argument('--inventory-ttl', action='store', type=int, default=86400)
+        parser.add_argument('--dns-concurrency', action='store', type=int, default=16)
+        parser.add_argument('--dns-timeout', action='store', type=float, default=10.0)
+        parser.add_argument('--zone-file', action='store')
+        parser.add_argument('--inventory', action='store')
+        parser.add_argument('--answers', action='store')
+        parser.add_argument('--offline', action='store_true')
+        parser.add_argument('--validate', action='store_true')
+        parser.add_argument('--no-validate', action='store_true')
         self.args = parser.parse_args()
         self.cfgFile = self.args.file
         self.outputDir = self.args.dir
         self.getValue = self.args.get
         self.nsxCfgFile = self.args.nsx
+        self.nsxDir = self.args.nsx_dir
         self.setKey = self.args.set
         self.setValue = self.args.value
+        self.updateList = self.args.update
+        self.batchFile = self.args.batch
         self.installDir = self.args.install
         self.infraId = self.args.id
         self.templateFile = self.args.template
         self.dualNic = self.args.dual
         self.yamlFile = self.args.yaml
+        self.outputFormat = self.args.format
+        self.renderJobs = self.args.jobs
+        self.ignUrl = self.args.ign_url
+        self.serveIgn = self.args.serve
+        self.ignCompress = self.args.compress
+        self.forceRender = self.args.force
+        self.addWorkers = self.args.add_workers
+        self.traceFile = self.args.trace
+        self.traceReport = self.args.trace_report
+        self.promFile = self.args.prom
+        self.traceCluster = self.args.cluster
+        self.cacheDir = self.args.cache_dir
+        self.refreshZone = self.args.refresh_zone
+        self.refreshInventory = self.args.refresh_inventory
+        self.inventoryTtl = self.args.inventory_ttl
+        self.reuseSession = self.args.reuse_session
+        self.dnsConcurrency = self.args.dns_concurrency
+        self.dnsTimeout = self.args.dns_timeout
+        self.zoneFile = self.args.zone_file
+        self.inventoryFile = self.args.inventory
+        self.answerFile = self.args.answers
+        self.offline = self.args.offline
+        self.validateOnly = self.args.validate
+        self.skipValidate = self.args.no_validate
 
 def main():
     osConfig()
@@ -24,8 +24,31 @@ data "vsphere_resource_pool" "pool" {
   datacenter_id = data.vsphere_datacenter.dc.id
 }
 
-data "vsphere_datastore" "datastore" {
-  name          = var.vsphere_datastore
+data "vsphere_compute_cluster" "cluster" {
+  name          = var.vsphere_cluster
+  datacenter_id = data.vsphere_datacenter.dc.id
+}
+
+# Node specs from tfConfig.py carry their size, datastore and host, older ones use the defaults
+locals {
+  node_datastores = distinct(concat([for node in var.bootstrap_spec : lookup(node, "datastore", var.vsphere_datastore)],
+                                    [for node in var.master_spec : lookup(node, "datastore", var.vsphere_datastore)],
+                                    [for node in var.worker_spec : lookup(node, "datastore", var.vsphere_datastore)]))
+  node_hosts      = distinct(compact(concat([for node in var.bootstrap_spec : lookup(node, "host", "")],
+                                            [for node in var.master_spec : lookup(node, "host", "")],
+                                            [for node in var.worker_spec : lookup(node, "host", "")])))
+  master_hosts    = distinct(compact([for node in var.master_spec : lookup(node, "host", "")]))
+}
+
+data "vsphere_datastore" "node" {
+  for_each      = toset(local.node_datastores)
+  name          = each.key
+  datacenter_id = data.vsphere_datacenter.dc.id
+}
+
+data "vsphere_host" "node" {
+  for_each      = toset(local.node_hosts)
+  name          = each.key
   datacenter_id = data.vsphere_datacenter.dc.id
 }
 
@@ -57,7 +80,7 @@ data "vsphere_virtual_machine" "worker_template" {
 }
 
 resource "vsphere_tag_category" "Id" {
-  name        = "terraform-role-category"
+  name        = "terraform-role-category-${var.infra_id}"
   cardinality = "SINGLE"
   description = "Managed by Terraform"
 
@@ -94,10 +117,11 @@ data "local_file" "worker_ignition" {
 resource "vsphere_virtual_machine" "bootstrap_node" {
   for_each         = var.bootstrap_spec
   name             = "${each.key}"
-  num_cpus         = 4
-  memory           = 16384
-  datastore_id     = data.vsphere_datastore.datastore.id
+  num_cpus         = lookup(each.value, "num_cpus", 4)
+  memory           = lookup(each.value, "memory", 16384)
+  datastore_id     = data.vsphere_datastore.node[lookup(each.value, "datastore", var.vsphere_datastore)].id
   resource_pool_id = data.vsphere_resource_pool.pool.id
+  host_system_id   = lookup(each.value, "host", "") != "" ? data.vsphere_host.node[each.value.host].id : null
   guest_id         = data.vsphere_virtual_machine.bootstrap_template.guest_id
   scsi_type        = data.vsphere_virtual_machine.bootstrap_template.scsi_type
   folder           = data.vsphere_folder.folder.path
@@ -115,7 +139,7 @@ resource "vsphere_virtual_machine" "bootstrap_node" {
 
   disk {
     label = "disk0"
-    size = 100
+    size = lookup(each.value, "disk_size", 100)
     thin_provisioned = data.vsphere_virtual_machine.bootstrap_template.disks.0.thin_provisioned
   }
 
@@ -135,10 +159,11 @@ resource "vsphere_virtual_machine" "bootstrap_node" {
 resource "vsphere_virtual_machine" "master_node" {
   for_each         = var.master_spec
   name             = "${each.key}"
-  num_cpus         = 4
-  memory           = 16384
-  datastore_id     = data.vsphere_datastore.datastore.id
+  num_cpus         = lookup(each.value, "num_cpus", 4)
+  memory           = lookup(each.value, "memory", 16384)
+  datastore_id     = data.vsphere_datastore.node[lookup(each.value, "datastore", var.vsphere_datastore)].id
   resource_pool_id = data.vsphere_resource_pool.pool.id
+  host_system_id   = lookup(each.value, "host", "") != "" ? data.vsphere_host.node[each.value.host].id : null
   guest_id         = data.vsphere_virtual_machine.master_template.guest_id
   scsi_type        = data.vsphere_virtual_machine.master_template.scsi_type
   folder           = data.vsphere_folder.folder.path
@@ -156,7 +181,7 @@ resource "vsphere_virtual_machine" "master_node" {
 
   disk {
     label = "disk0"
-    size = 100
+    size = lookup(each.value, "disk_size", 100)
     thin_provisioned = data.vsphere_virtual_machine.master_template.disks.0.thin_provisioned
   }
 
@@ -176,10 +201,11 @@ resource "vsphere_virtual_machine" "master_node" {
 resource "vsphere_virtual_machine" "worker_node" {
   for_each         = var.worker_spec
   name             = "${each.key}"
-  num_cpus         = 4
-  memory           = 16384
-  datastore_id     = data.vsphere_datastore.datastore.id
+  num_cpus         = lookup(each.value, "num_cpus", 4)
+  memory           = lookup(each.value, "memory", 16384)
+  datastore_id     = data.vsphere_datastore.node[lookup(each.value, "datastore", var.vsphere_datastore)].id
   resource_pool_id = data.vsphere_resource_pool.pool.id
+  host_system_id   = lookup(each.value, "host", "") != "" ? data.vsphere_host.node[each.value.host].id : null
   guest_id         = data.vsphere_virtual_machine.worker_template.guest_id
   scsi_type        = data.vsphere_virtual_machine.worker_template.scsi_type
   folder           = data.vsphere_folder.folder.path
@@ -197,7 +223,7 @@ resource "vsphere_virtual_machine" "worker_node" {
 
   disk {
     label = "disk0"
-    size = 100
+    size = lookup(each.value, "disk_size", 100)
     thin_provisioned = data.vsphere_virtual_machine.worker_template.disks.0.thin_provisioned
   }
 
@@ -214,3 +240,11 @@ resource "vsphere_virtual_machine" "worker_node" {
   tags = ["${vsphere_tag.Id.id}"]
   depends_on = [vsphere_virtual_machine.master_node]
 }
+
+# DRS keeps the masters apart after the initial placement when they were put on separate hosts
+resource "vsphere_compute_cluster_vm_anti_affinity_rule" "master_anti_affinity" {
+  count               = length(local.master_hosts) > 1 ? 1 : 0
+  name                = "${var.infra_id}-master-anti-affinity"
+  compute_cluster_id  = data.vsphere_compute_cluster.cluster.id
+  virtual_machine_ids = [for node in vsphere_virtual_machine.master_node : node.id]
+}